@@ -0,0 +1,217 @@
+"""Cold-start harness for the Lambda handlers.
+
+Every run starts a fresh interpreter with `python -X importtime`, imports one
+handler module and invokes it twice, so each number is a real cold start:
+
+* import_ms       - importing the handler module (Lambda's init phase)
+* first_invoke_ms - the first invocation, including any lazily built clients
+* warm_invoke_ms  - the second invocation in the same process
+
+AWS calls go to a moto server started by the harness (via AWS_ENDPOINT_URL),
+and the authorizer verifies a real RS256 token against a local JWKS endpoint,
+so no AWS account is needed. The heaviest top-level imports reported by
+-X importtime are listed per handler so regressions can be traced:
+
+    python benchmarks/bench_cold_start.py --runs 5 --output cold.json
+"""
+import os, sys, json, time, logging, argparse, statistics, subprocess, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import boto3
+from moto.server import ThreadedMotoServer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import bulk
+
+SHARED_DIR = os.path.join(ROOT, 'src', 'shared')
+TABLE, RAW_BUCKET, THUMB_BUCKET = "carnus-bench", "carnus-bench-raw", "carnus-bench-thumbs"
+USER = "00000000-bench-user"
+IMAGE_ID = "0123456789"
+
+# --- LOCAL STAND-INS ---
+def start_moto(port):
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    server.start()
+    return f"http://127.0.0.1:{port}"
+
+def seed(endpoint):
+    """Creates the table, buckets and the rows each handler reads."""
+    kw = dict(endpoint_url=endpoint, region_name="us-east-1")
+    ddb = boto3.client("dynamodb", **kw)
+    ddb.create_table(
+        TableName=TABLE, BillingMode="PAY_PER_REQUEST",
+        AttributeDefinitions=[{"AttributeName": n, "AttributeType": "S"} for n in ("PK", "SK", "GSI1PK", "GSI1SK", "ImageId", "CaptureDate")],
+        KeySchema=[{"AttributeName": "PK", "KeyType": "HASH"}, {"AttributeName": "SK", "KeyType": "RANGE"}],
+        GlobalSecondaryIndexes=[
+            {"IndexName": "ImageIdIndex", "Projection": {"ProjectionType": "ALL"},
+             "KeySchema": [{"AttributeName": "ImageId", "KeyType": "HASH"}, {"AttributeName": "CaptureDate", "KeyType": "RANGE"}]},
+            {"IndexName": "GSI1", "Projection": {"ProjectionType": "ALL"},
+             "KeySchema": [{"AttributeName": "GSI1PK", "KeyType": "HASH"}, {"AttributeName": "GSI1SK", "KeyType": "RANGE"}]},
+        ],
+    )
+    table = boto3.resource("dynamodb", **kw).Table(TABLE)
+    sk, key = f"IMAGE#{IMAGE_ID}", f"protected/{USER}/2024/01/01/bench.dng.jpg"
+    table.put_item(Item={"PK": f"USER#{USER}#IMAGE", "SK": sk, "ImageId": IMAGE_ID, "CaptureDate": "2024-01-01T10:00:00",
+                         "ImageName": "bench.dng", "Labels": ["Dog"], "CameraModel": "Bench", "ThumbnailKey": key})
+    table.put_item(Item={"PK": f"USER#{USER}#TAG#Dog", "SK": sk, "GSI1PK": "TAG#Dog", "GSI1SK": sk,
+                         "ImageName": "bench.dng", "ImageId": IMAGE_ID, "Timestamp": "2024-01-01T10:00:00", "ThumbnailKey": key})
+    table.put_item(Item={"PK": f"USER#{USER}#TAG_CLOUD", "SK": "TAG#Dog", "Count": 1, "LabelName": "Dog"})
+    table.put_item(Item={"PK": f"USER#{USER}#PROFILE", "SK": "METADATA", "Email": "bench@example.com", "EmailVerified": True})
+
+    s3 = boto3.client("s3", **kw)
+    for bucket in (RAW_BUCKET, THUMB_BUCKET):
+        s3.create_bucket(Bucket=bucket)
+    s3.put_object(Bucket=THUMB_BUCKET, Key=key, Body=sample_jpeg())
+
+def sample_jpeg(size=(2048, 1365)):
+    import io
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new("RGB", size, (96, 128, 64)).save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+def put_batch(endpoint, n_images=4):
+    """Uploads a binary batch and returns its key; the processor deletes it unless DEBUG."""
+    jpeg = sample_jpeg()
+    records = [
+        bulk.encode_record(f"bench{i}.dng", {"EXIF:DateTimeOriginal": f"2024:01:01 10:00:{i:02d}", "EXIF:Make": "Bench"}, jpeg)
+        for i in range(n_images)
+    ]
+    key = bulk.batch_key(USER, "bench.bin")
+    boto3.client("s3", endpoint_url=endpoint, region_name="us-east-1").put_object(
+        Bucket=RAW_BUCKET, Key=key, Body=bulk.pack_container(USER, records))
+    return key
+
+class Jwks:
+    """Local stand-in for the Cognito issuer: a JWKS endpoint and a signed token."""
+    def __init__(self):
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from jose import jwk, jwt
+
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+        public = jwk.construct(pem, "RS256").public_key().to_dict()
+        body = json.dumps({"keys": [{**public, "kid": "bench", "use": "sig"}]}).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.issuer = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.token = jwt.encode(
+            {"sub": USER, "email": "bench@example.com", "email_verified": True, "iss": self.issuer, "exp": int(time.time()) + 86400},
+            pem, algorithm="RS256", headers={"kid": "bench"})
+
+# --- HANDLERS ---
+def api_event(path=None, method="GET", **authorizer):
+    return {"httpMethod": method, "pathParameters": path, "queryStringParameters": None,
+            "requestContext": {"authorizer": {"principalId": USER, "sub": USER, **authorizer}}}
+
+def handlers(endpoint, jwks):
+    return {
+        "tags_cloud": ("src/tags", "tag_handler", "handler", api_event()),
+        "tags_gallery": ("src/tags", "tag_handler", "handler", api_event({"tag_name": "Dog"})),
+        "image": ("src/image", "image_handler", "handler", api_event({"image_id": IMAGE_ID})),
+        "stats": ("src/stats", "stats_handler", "handler", {}),
+        "profile": ("src/profile", "profile_handler", "handler", api_event(claims={"email": "bench@example.com"})),
+        "authorizer": ("src/auth", "authorizer", "handler", {"authorizationToken": f"Bearer {jwks.token}"}),
+        "post_confirmation": ("src/triggers", "post_confirmation", "handler",
+                              {"request": {"userAttributes": {"sub": "bench-new-user", "email": "new@example.com", "email_verified": "true"}}}),
+        "processor": ("src/processor", "processor", "lambda_handler",
+                      {"Records": [{"s3": {"bucket": {"name": RAW_BUCKET}, "object": {"key": put_batch(endpoint)}}}]}),
+    }
+
+DRIVER = r"""
+import sys, json, time, copy, importlib
+handler_dir, shared_dir, module, function = sys.argv[1:5]
+event = json.loads(sys.stdin.read())
+sys.path[:0] = [handler_dir, shared_dir]
+t0 = time.perf_counter()
+fn = getattr(importlib.import_module(module), function)
+t1 = time.perf_counter()
+first = fn(copy.deepcopy(event), None)
+t2 = time.perf_counter()
+fn(copy.deepcopy(event), None)
+t3 = time.perf_counter()
+status = first.get("statusCode") if isinstance(first, dict) and "statusCode" in first else "ok"
+print("BENCH" + json.dumps({"import_ms": (t1 - t0) * 1e3, "first_invoke_ms": (t2 - t1) * 1e3, "warm_invoke_ms": (t3 - t2) * 1e3, "status": status}))
+"""
+
+def parse_importtime(stderr, top=5):
+    """Returns the heaviest top-level imports as [(module, cumulative ms)]."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line: continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented two spaces per level
+        if not name[1:].startswith(" "):
+            rows.append((name.strip(), int(cumulative) / 1e3))
+    return [(n, round(ms, 1)) for n, ms in sorted(rows, key=lambda r: -r[1])[:top]]
+
+def run_once(spec, env):
+    handler_dir, module, function, event = spec
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", DRIVER, os.path.join(ROOT, handler_dir), SHARED_DIR, module, function],
+        input=json.dumps(event), capture_output=True, text=True, env=env, timeout=300)
+    line = next((l for l in proc.stdout.splitlines() if l.startswith("BENCH")), None)
+    if line is None:
+        raise RuntimeError(f"{module} failed:\n{proc.stderr[-2000:]}")
+    return json.loads(line[len("BENCH"):]), parse_importtime(proc.stderr)
+
+def summarize(samples):
+    return {"median": round(statistics.median(samples), 1), "min": round(min(samples), 1), "max": round(max(samples), 1)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure handler import time and first-invocation latency")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per handler")
+    parser.add_argument("--only", nargs="*", help="Handler names to run (default: all)")
+    parser.add_argument("--moto-port", type=int, default=5055)
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    # Dummy credentials for the harness and every handler process
+    os.environ.update({"AWS_DEFAULT_REGION": "us-east-1", "AWS_ACCESS_KEY_ID": "bench", "AWS_SECRET_ACCESS_KEY": "bench"})
+    endpoint = start_moto(args.moto_port)
+    seed(endpoint)
+    jwks = Jwks()
+    env = {
+        **os.environ,
+        "AWS_ENDPOINT_URL": endpoint,
+        "TABLE_NAME": TABLE, "THUMB_BUCKET": THUMB_BUCKET,
+        # Keeps the processor's batch in place so every run replays it
+        "DEBUG": "true",
+    }
+
+    report = {"runs": args.runs, "python": sys.version.split()[0], "handlers": {}}
+    for name, spec in handlers(endpoint, jwks).items():
+        if args.only and name not in args.only: continue
+        results, heaviest = [], []
+        for _ in range(args.runs):
+            result, heaviest = run_once(spec, env)
+            results.append(result)
+        report["handlers"][name] = {
+            "status": results[-1]["status"],
+            **{k: summarize([r[k] for r in results]) for k in ("import_ms", "first_invoke_ms", "warm_invoke_ms")},
+            "heaviest_imports_ms": heaviest,
+        }
+        print(f"{name:18s} import {report['handlers'][name]['import_ms']['median']:8.1f} ms | "
+              f"first {report['handlers'][name]['first_invoke_ms']['median']:8.1f} ms | "
+              f"warm {report['handlers'][name]['warm_invoke_ms']['median']:7.1f} ms", file=sys.stderr)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Micro-benchmark for the processor's EXIF field resolution.
+
+Builds exiftool `-G`-shaped records (a few hundred keys, a handful of camera
+key sets) and times:
+
+* legacy - one regex scan + sort per field plus the per-key omit regexes,
+           as process_image did before exif_fields
+* cold   - exif_fields.resolve/storable with the plan cache cleared per record
+* warm   - exif_fields.resolve/storable with plans memoized by key set
+
+Every record is checked to resolve identically under both engines.
+
+    python benchmarks/bench_exif_fields.py --records 2000 --keys 600
+"""
+import os, re, sys, json, time, random, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'processor'))
+import exif_fields
+
+GROUPS = ["EXIF", "File", "Composite", "XMP", "IPTC", "MakerNotes", "ICC_Profile", "Sony", "Nikon"]
+REAL_KEYS = [
+    "EXIF:Make", "EXIF:Model", "EXIF:LensModel", "Composite:LensID", "EXIF:ISO", "EXIF:FNumber",
+    "Composite:Aperture", "EXIF:ExposureTime", "Composite:ShutterSpeed", "EXIF:DateTimeOriginal",
+    "EXIF:CreateDate", "Composite:SubSecDateTimeOriginal", "EXIF:GPSLatitude", "EXIF:GPSLatitudeRef",
+    "EXIF:GPSLongitude", "EXIF:GPSLongitudeRef", "EXIF:UniqueCameraModel", "MakerNotes:LensModel",
+    "EXIF:ThumbnailImage", "ICC_Profile:ProfileDescription", "EXIF:ImageWidth", "File:FileSize",
+]
+
+# --- LEGACY ENGINE ---
+def get_fuzzy_tag(data, pattern):
+    matches = [
+        (k, str(v).strip()) for k, v in data.items()
+        if re.search(pattern, k, re.I) and v is not None and str(v).strip() != ""
+    ]
+    if not matches: return None
+    return sorted(matches, key=lambda x: len(x[0]))[0][1]
+
+def legacy(raw):
+    fields = {name: get_fuzzy_tag(raw, p) for name, p in exif_fields.FIELD_SPEC.items()}
+    exif = {}
+    for key, value in raw.items():
+        if any(re.search(p, key, re.I) for p in exif_fields.OMIT): continue
+        if isinstance(value, (bytes, bytearray)) or "(Binary data" in str(value): continue
+        exif[re.sub(r'[^a-zA-Z0-9_]', '_', key).strip('_')] = value
+    return fields, exif
+
+def compiled(raw):
+    return exif_fields.resolve(raw), exif_fields.storable(raw)
+
+# --- CORPUS ---
+def camera_keys(rng, n):
+    keys = list(REAL_KEYS)
+    while len(keys) < n:
+        keys.append(f"{rng.choice(GROUPS)}:Tag{rng.randrange(10 ** 6)}")
+    rng.shuffle(keys)
+    return keys
+
+def build_records(n_records, n_keys, n_cameras, seed):
+    rng = random.Random(seed)
+    cameras = [camera_keys(rng, n_keys) for _ in range(n_cameras)]
+    records = []
+    for i in range(n_records):
+        rec = {}
+        for k in cameras[i % n_cameras]:
+            if k.endswith("Image"): rec[k] = "(Binary data 8192 bytes, use -b option to extract)"
+            elif "Date" in k: rec[k] = f"2024:0{rng.randint(1, 9)}:1{rng.randint(0, 9)} 10:00:00"
+            elif rng.random() < 0.05: rec[k] = ""
+            else: rec[k] = f"value {rng.randrange(10 ** 4)}"
+        records.append(rec)
+    return records
+
+def timed(fn, records, clear=False):
+    t0 = time.perf_counter()
+    for rec in records:
+        if clear: exif_fields._plan.cache_clear()
+        fn(rec)
+    elapsed = time.perf_counter() - t0
+    return {"seconds": round(elapsed, 4), "per_record_us": round(elapsed / len(records) * 1e6, 2)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark EXIF field resolution")
+    parser.add_argument("--records", type=int, default=2000)
+    parser.add_argument("--keys", type=int, default=600, help="Keys per exiftool record")
+    parser.add_argument("--cameras", type=int, default=4, help="Distinct key sets in the corpus")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    records = build_records(args.records, args.keys, args.cameras, args.seed)
+    mismatches = sum(legacy(r) != compiled(r) for r in records)
+
+    exif_fields._plan.cache_clear()
+    report = {
+        "records": args.records, "keys": args.keys, "cameras": args.cameras,
+        "mismatches": mismatches,
+        "legacy": timed(legacy, records),
+        "cold": timed(compiled, records, clear=True),
+        "warm": timed(compiled, records),
+    }
+    report["speedup_warm"] = round(report["legacy"]["seconds"] / report["warm"]["seconds"], 1)
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
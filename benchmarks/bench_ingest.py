@@ -0,0 +1,315 @@
+"""Throughput benchmark for the bulk.py ingestion client.
+
+Generates a synthetic corpus of DNG files, then measures:
+
+* serial  - bulk.process_image per file plus the batch/serialize/upload
+            loop, with a timing breakdown per stage
+* pipeline - bulk.run_pipeline end to end, for files/sec with every stage
+            overlapping
+
+bulk.py only reads RAW containers (through LibRaw), so the JPEG share of the
+corpus is DNGs whose preview is a full-size baseline JPEG (decoded in draft
+mode); `--bare-ratio` of them carry only a tiny preview and take the demosaic
+path instead.
+
+Uploads go to an in-memory S3 stand-in, so no AWS account is needed. The
+report is printed as JSON so runs can be diffed release to release:
+
+    python benchmarks/bench_ingest.py --files 60 --output bench.json
+"""
+import os, io, sys, json, time, shutil, struct, argparse, tempfile, resource
+from collections import defaultdict, Counter
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bulk
+
+# --- SYNTHETIC CORPUS ---
+def _ifd(entries, offset):
+    """Packs a little-endian TIFF IFD placed at `offset`, spilling long values after it."""
+    entries = sorted(entries)
+    size = 2 + len(entries) * 12 + 4
+    head, blobs = bytearray(struct.pack('<H', len(entries))), bytearray()
+    for tag, typ, count, val in entries:
+        if len(val) <= 4:
+            head += struct.pack('<HHI', tag, typ, count) + val.ljust(4, b'\0')
+        else:
+            head += struct.pack('<HHII', tag, typ, count, offset + size + len(blobs))
+            blobs += val + b'\0' * (len(val) % 2)
+    return bytes(head + struct.pack('<I', 0) + blobs)
+
+def write_dng(path, raw_size, preview_size, rng):
+    """Writes a minimal DNG that LibRaw and exiftool accept.
+
+    IFD0 holds a baseline JPEG preview (like camera and Adobe DNGs do) and
+    its SubIFD holds a 16-bit RGGB CFA image. A `preview_size` of None writes
+    a 160px preview, which sends bulk.decode_preview down the demosaic path.
+    """
+    width, height = raw_size
+    preview_size = preview_size or (160, 120)
+    cfa = rng.integers(0, 4095, size=(height, width), dtype=np.uint16).tobytes()
+
+    # Smooth gradients with noise compress like photographs rather than like static
+    gy, gx = np.mgrid[0:preview_size[1], 0:preview_size[0]]
+    base = np.stack([gx * 255 // preview_size[0], gy * 255 // preview_size[1], (gx + gy) * 127 // sum(preview_size)], -1)
+    pixels = np.clip(base + rng.integers(-12, 12, base.shape), 0, 255).astype(np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, format='JPEG', quality=92)
+    preview = buf.getvalue()
+
+    S = lambda *v: struct.pack(f'<{len(v)}H', *v)
+    L = lambda *v: struct.pack(f'<{len(v)}I', *v)
+    A = lambda s: s.encode() + b'\0'
+    srational = b''.join(struct.pack('<ii', v, 10000) for v in (10000, 0, 0, 0, 10000, 0, 0, 0, 10000))
+
+    def ifd0(sub_off, preview_off):
+        return [
+            (254, 4, 1, L(1)), (256, 4, 1, L(preview_size[0])), (257, 4, 1, L(preview_size[1])),
+            (258, 3, 3, S(8, 8, 8)), (259, 3, 1, S(7)), (262, 3, 1, S(6)),
+            (271, 2, 7, A('Carnus')), (272, 2, 10, A('Bench DNG')),
+            (273, 4, 1, L(preview_off)), (277, 3, 1, S(3)), (278, 4, 1, L(preview_size[1])), (279, 4, 1, L(len(preview))),
+            (306, 2, 20, A('2024:05:17 09:41:07')), (330, 4, 1, L(sub_off)),
+            (50706, 1, 4, bytes((1, 4, 0, 0))), (50708, 2, 13, A('Carnus Bench')),
+            (50721, 10, 9, srational), (50728, 5, 3, struct.pack('<6I', 1, 1, 1, 1, 1, 1)),
+        ]
+
+    def sub_ifd(raw_off):
+        return [
+            (254, 4, 1, L(0)), (256, 4, 1, L(width)), (257, 4, 1, L(height)), (258, 3, 1, S(16)),
+            (259, 3, 1, S(1)), (262, 3, 1, S(32803)), (273, 4, 1, L(raw_off)), (277, 3, 1, S(1)),
+            (278, 4, 1, L(height)), (279, 4, 1, L(len(cfa))), (284, 3, 1, S(1)),
+            (33421, 3, 2, S(2, 2)), (33422, 1, 4, bytes((0, 1, 1, 2))), (50717, 4, 1, L(4095)),
+        ]
+
+    # Entry sizes don't depend on the offsets, so one dry run gives the layout
+    sub_off = 8 + len(_ifd(ifd0(0, 0), 8))
+    preview_off = sub_off + len(_ifd(sub_ifd(0), sub_off))
+    raw_off = preview_off + len(preview)
+    with open(path, 'wb') as f:
+        f.write(b'II*\0' + L(8))
+        f.write(_ifd(ifd0(sub_off, preview_off), 8))
+        f.write(_ifd(sub_ifd(raw_off), sub_off))
+        f.write(preview)
+        f.write(cfa)
+
+def build_corpus(directory, count, raw_size, preview_size, bare_ratio, seed=7):
+    """Writes `count` DNGs: full-size JPEG previews, `bare_ratio` of them without a usable one."""
+    rng = np.random.default_rng(seed)
+    bare_every = round(1 / bare_ratio) if bare_ratio else 0
+    files = []
+    for i in range(count):
+        bare = bare_every and i % bare_every == 0
+        path = os.path.join(directory, f"BENCH_{i:05d}.dng")
+        write_dng(path, raw_size, None if bare else preview_size, rng)
+        files.append(path)
+    return files
+
+# --- LOCAL S3 STAND-IN ---
+class LocalS3:
+    """Enough of the S3 client for BatchUploader: keeps object sizes, sleeps `latency` per put."""
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        if self.latency: time.sleep(self.latency)
+        self.objects[Key] = len(Body)
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': self.objects[Key]}
+
+class LocalUploader(bulk.BatchUploader):
+    """BatchUploader with its Cognito login replaced by the local stand-in."""
+    def __init__(self, s3, spool_dir, batch_format="binary"):
+        self._local = s3
+        super().__init__({'aws': {'raw_source_s3_bucket': 'bench', 'region': 'local'}}, batch_format, {'spool_dir': spool_dir})
+
+    def _refresh(self):
+        self.s3, self.user_sub, self.expires_at = self._local, 'bench-user', time.time() + 86400
+
+# --- MEASUREMENT ---
+class StageClock:
+    def __init__(self):
+        self.totals, self.counts = defaultdict(float), Counter()
+
+    def add(self, stage, seconds):
+        self.totals[stage] += seconds
+        self.counts[stage] += 1
+
+    def wrap(self, stage, fn):
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - t0)
+        return timed
+
+    def report(self):
+        return {
+            stage: {"total_s": round(total, 4), "calls": self.counts[stage], "mean_ms": round(total / self.counts[stage] * 1000, 3)}
+            for stage, total in self.totals.items()
+        }
+
+def peak_rss_mb():
+    scale = 1024 if sys.platform != 'darwin' else 1024 * 1024
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1),
+    }
+
+def bench_serial(files, ingest_cfg, exif_pool, workdir):
+    """bulk.process_image + batching loop on one thread, timed stage by stage."""
+    clock = StageClock()
+    s3 = LocalS3(ingest_cfg.get('upload_latency', 0.0))
+    uploader = LocalUploader(s3, os.path.join(workdir, 'spool-serial'), ingest_cfg.get('batch_format', 'binary'))
+    codecs = bulk.batch_codecs(ingest_cfg)
+    batch_size = ingest_cfg.get('batch_size', 20)
+
+    real_codecs, real_serialize, real_put = dict(bulk.CODECS), bulk.serialize_batch, s3.put_object
+    real_exif, real_decode = bulk.get_exif_with_tool, bulk.decode_preview
+    sources = Counter()
+
+    def decode_preview(*args, **kwargs):
+        # decode/resize/encode come from the timings decode_preview reports itself
+        jpeg, info = real_decode(*args, **kwargs)
+        for stage, seconds in info['timings'].items():
+            clock.add(stage, seconds)
+        sources[info['source']] += 1
+        return jpeg, info
+
+    # process_image looks these up at call time, so the timers sit on its real path
+    bulk.CODECS.update({name: clock.wrap(name if name != 'br' else 'brotli', fn) for name, fn in real_codecs.items() if name != 'raw'})
+    bulk.serialize_batch = clock.wrap('serialize', real_serialize)
+    bulk.get_exif_with_tool = clock.wrap('exiftool', real_exif)
+    bulk.decode_preview = decode_preview
+    s3.put_object = clock.wrap('upload', real_put)
+    try:
+        t0 = time.perf_counter()
+        batch, failed = [], 0
+        for path in files:
+            # Without exiftool a canned record stands in, as the pipeline run gets error records
+            canned = None if exif_pool else {"SourceFile": path, "EXIF:Make": "Carnus", "EXIF:Model": "Bench DNG"}
+            record = bulk.process_image(path, exif_pool=exif_pool, exif_dict=canned, codecs=codecs,
+                                        preview_cfg=ingest_cfg.get('preview', {}))
+            if record is None:
+                failed += 1
+                continue
+            batch.append(record)
+            if len(batch) >= batch_size:
+                uploader.send(batch)
+                batch = []
+        if batch: uploader.send(batch)
+        elapsed = time.perf_counter() - t0
+    finally:
+        bulk.CODECS.clear()
+        bulk.CODECS.update(real_codecs)
+        bulk.serialize_batch = real_serialize
+        bulk.get_exif_with_tool, bulk.decode_preview = real_exif, real_decode
+
+    uploaded = sum(s3.objects.values())
+    return {
+        "files": len(files),
+        "seconds": round(elapsed, 3),
+        "files_per_sec": round(len(files) / elapsed, 2),
+        "stages": clock.report(),
+        "decode_paths": dict(sources),
+        "failed_files": failed,
+        "batches": len(s3.objects),
+        "bytes_uploaded": uploaded,
+        "bytes_per_image": round(uploaded / len(files)),
+    }
+
+def bench_pipeline(files, ingest_cfg, workdir):
+    """bulk.run_pipeline end to end against the stand-in."""
+    s3 = LocalS3(ingest_cfg.get('upload_latency', 0.0))
+    uploader = LocalUploader(s3, os.path.join(workdir, 'spool-pipeline'), ingest_cfg.get('batch_format', 'binary'))
+    t0 = time.perf_counter()
+    failed = bulk.run_pipeline(files, ingest_cfg, uploader)
+    elapsed = time.perf_counter() - t0
+    uploaded = sum(s3.objects.values())
+    return {
+        "files": len(files),
+        "seconds": round(elapsed, 3),
+        "files_per_sec": round(len(files) / elapsed, 2),
+        "batches": len(s3.objects),
+        "failed_batches": len(failed),
+        "bytes_uploaded": uploaded,
+        "bytes_per_image": round(uploaded / len(files)),
+    }
+
+def parse_size(value):
+    w, h = value.lower().split('x')
+    return int(w), int(h)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=40)
+    parser.add_argument("--raw-size", type=parse_size, default=(1200, 800), help="CFA dimensions, e.g. 1200x800")
+    parser.add_argument("--preview-size", type=parse_size, default=(6000, 4000), help="Embedded JPEG preview, e.g. 6000x4000")
+    parser.add_argument("--bare-ratio", type=float, default=0.1, help="Share of files without a usable preview")
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--batch-format", choices=["binary", "json"], default="binary")
+    parser.add_argument("--upload-latency", type=float, default=0.0, help="Seconds added to every stand-in put")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="Decode processes for the pipeline run")
+    parser.add_argument("--exiftool", default=shutil.which("exiftool"), help="exiftool binary; omitted stages use a canned record")
+    parser.add_argument("--skip-serial", action="store_true")
+    parser.add_argument("--skip-pipeline", action="store_true")
+    parser.add_argument("--workdir", help="Keep the corpus here instead of a temp dir")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="carnus-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    corpus_dir = os.path.join(workdir, "corpus")
+    os.makedirs(corpus_dir, exist_ok=True)
+
+    ingest_cfg = {
+        "batch_size": args.batch_size,
+        "batch_format": args.batch_format,
+        "upload_latency": args.upload_latency,
+        "exif_batch_size": 8,
+        "pipeline": {"decode_workers": args.workers},
+        **({"exiftool_path": args.exiftool} if args.exiftool else {}),
+    }
+
+    try:
+        t0 = time.perf_counter()
+        files = build_corpus(corpus_dir, args.files, args.raw_size, args.preview_size, args.bare_ratio)
+        report = {
+            "corpus": {
+                "files": len(files),
+                "raw_size": args.raw_size,
+                "preview_size": args.preview_size,
+                "bare_ratio": args.bare_ratio,
+                "bytes_on_disk": sum(os.path.getsize(f) for f in files),
+                "generated_in_s": round(time.perf_counter() - t0, 3),
+            },
+            "config": {k: v for k, v in ingest_cfg.items() if k != "exiftool_path"},
+            "exiftool": bool(args.exiftool),
+        }
+
+        if not args.skip_serial:
+            exif_pool = bulk.ExifToolPool(1, args.exiftool) if args.exiftool else None
+            try:
+                report["serial"] = bench_serial(files, ingest_cfg, exif_pool, workdir)
+            finally:
+                if exif_pool: exif_pool.close()
+        if not args.skip_pipeline:
+            # Without exiftool the pool returns error records and the pipeline carries on
+            report["pipeline"] = bench_pipeline(files, ingest_cfg, workdir)
+        report["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    out = json.dumps(report, indent=2)
+    print(out)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + "\n")
+
+if __name__ == "__main__":
+    main()
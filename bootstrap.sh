@@ -94,6 +94,37 @@ ingestion:
   min_confidence: 75
   max_labels: 15
   extensions: [".cr2", ".cr3", ".arw", ".nef", ".dng"]
+  include: []
+  exclude: [".*", "*/.*", "*@eaDir*", "*#recycle*"]
+  exiftool_path: "exiftool"
+  exiftool_timeout: 30
+  exif_batch_size: 8
+  preview:
+    target: 2048
+    min_thumb: 1024
+    quality: 85
+  batch_format: "binary"
+  codecs:
+    exif: "br"
+    thumb: "raw"
+  # Train with: python bulk.py /path/to/photos --train-dictionary ~/.carnus/exif.zdict
+  exif_dictionary: ""
+  upload:
+    max_attempts: 6
+    backoff_base: 0.5
+    backoff_cap: 30
+    refresh_margin: 300
+    enqueue_timeout: 10
+    spool_dir: "~/.carnus/spool"
+  manifest_path: "~/.carnus/manifest.sqlite"
+  manifest_hash: false
+  pipeline:
+    discover_workers: 8
+    exif_workers: 4
+    decode_workers: 8
+    compress_workers: 2
+    upload_workers: 2
+    queue_size: 64
   debug: true
   force_reprocess: false
 
@@ -1,5 +1,6 @@
-import os, io, json, base64, uuid, time, subprocess, argparse
-from concurrent.futures import ThreadPoolExecutor
+import os, sys, io, json, base64, uuid, time, subprocess, argparse, select, queue, threading, multiprocessing, sqlite3, hashlib, struct, random, fnmatch
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 import yaml
 import rawpy
@@ -8,13 +9,23 @@ import boto3
 from PIL import Image
 from pycognito import Cognito
 from tqdm import tqdm
-from botocore.exceptions import ClientError
+from botocore.config import Config
+try:
+    import zstandard
+except ImportError:  # only needed for ingestion.exif_dictionary
+    zstandard = None
+from botocore.exceptions import ClientError, BotoCoreError, EndpointConnectionError, ConnectionClosedError, ReadTimeoutError, ConnectTimeoutError
+
+# Field rules are shared with the processor Lambda so both sides agree on what is kept
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src", "processor"))
+import exif_fields
 
 def load_config(config_path="/opt/carnus/config.yaml"):
     with open(config_path, 'r') as f:
         return yaml.safe_load(f)
 
-def get_authenticated_session(config):
+def get_identity_credentials(config):
+    """Returns (temporary AWS credentials, identity id, user sub) for the configured Cognito user."""
     aws = config['aws']
     u_pool = Cognito(
         aws['user_pool_id'],
@@ -30,27 +41,399 @@ def get_authenticated_session(config):
     identity_id = id_res['IdentityId']
 
     creds_res = idp.get_credentials_for_identity(IdentityId=identity_id, Logins={provider: u_pool.id_token})
-    c = creds_res['Credentials']
+    return creds_res['Credentials'], identity_id, u_pool.id_claims['sub']
 
+def get_authenticated_session(config):
+    aws = config['aws']
+    c, identity_id, user_sub = get_identity_credentials(config)
     session = boto3.Session(
         aws_access_key_id=c['AccessKeyId'],
         aws_secret_access_key=c['SecretKey'],
         aws_session_token=c['SessionToken'],
         region_name=aws['region']
     )
-    return session.client('s3'), identity_id, u_pool.id_claims['sub']
+    return session.client('s3'), identity_id, user_sub
+
+# --- BATCH CONTAINER ---
+# Binary batch layout (version 1), read by src/processor/processor.py:
+#   magic "CRNB" | version u8 | 3 reserved bytes | header length u32 BE | header JSON | frames
+# Every field is one frame: u32 BE length followed by the encoded bytes. The
+# header indexes each image's fields as {"offset", "length", "codec"}, with
+# offsets pointing at the frame payload relative to the end of the header.
+# Fields compressed with a shared dictionary also carry its "dict" id.
+CONTAINER_MAGIC = b"CRNB"
+CONTAINER_VERSION = 1
+_PREAMBLE = struct.Struct(">4sB3xI")
+_FRAME = struct.Struct(">I")
+
+CODECS = {
+    'raw': lambda b: b,
+    'br': brotli.compress,
+}
+DEFAULT_CODECS = {'exif': 'br', 'thumb': 'raw'}
+
+def pack_container(user_id, records):
+    frames, images, offset = [], [], 0
+    for rec in records:
+        fields = {}
+        for name, (codec, data) in rec['fields'].items():
+            frames += [_FRAME.pack(len(data)), data]
+            fields[name] = {"offset": offset + _FRAME.size, "length": len(data), "codec": codec}
+            dict_id = getattr(CODECS[codec], 'dict_id', None)
+            if dict_id is not None: fields[name]["dict"] = dict_id
+            offset += _FRAME.size + len(data)
+        images.append({"filename": rec['filename'], "force_reprocess": rec['force_reprocess'], "fields": fields})
+
+    header = json.dumps({"user_id": user_id, "images": images}, separators=(',', ':')).encode()
+    return b"".join([_PREAMBLE.pack(CONTAINER_MAGIC, CONTAINER_VERSION, len(header)), header, *frames])
+
+def json_record(rec):
+    """Legacy JSON form: every field brotli-compressed and base64-encoded."""
+    out = {"filename": rec['filename'], "force_reprocess": rec['force_reprocess']}
+    for name, (codec, data) in rec['fields'].items():
+        if codec != 'br': raise ValueError(f"JSON batches need brotli fields, got {codec} for {name}")
+        out[name] = base64.b64encode(data).decode()
+    return out
+
+def record_size(rec):
+    return sum(_FRAME.size + len(data) for _, data in rec['fields'].values()) + len(rec['filename']) + 96
+
+def batch_key(user_sub, batch_id):
+    return f"incoming/{user_sub}/{batch_id}"
+
+# --- EXIF DICTIONARY ---
+def dictionary_key(user_sub, dict_id):
+    # The processor is only triggered for .bin/.json keys, so dictionaries can live beside the batches
+    return f"incoming/{user_sub}/dictionaries/{dict_id}.zdict"
+
+class ZstdDictCodec:
+    """Zstandard with a dictionary trained on exiftool output.
+
+    exiftool -G keys and most values repeat across images from the same
+    camera, so a shared dictionary lets each image's EXIF compress down to
+    what is actually unique about it. The id is zstd's own dictionary id,
+    which the processor uses to fetch the same dictionary from S3.
+    """
+    name = 'zstd-dict'
+
+    def __init__(self, path, level=19):
+        if zstandard is None:
+            raise RuntimeError("ingestion.exif_dictionary needs the 'zstandard' package")
+        with open(os.path.expanduser(path), 'rb') as f:
+            self.data = f.read()
+        self.zdict = zstandard.ZstdCompressionDict(self.data)
+        self.dict_id = self.zdict.dict_id()
+        self.level = level
+        self._local = threading.local()
+
+    def __call__(self, data):
+        # Compressors are not thread-safe; keep one per compress worker
+        cctx = getattr(self._local, 'cctx', None)
+        if cctx is None:
+            cctx = self._local.cctx = zstandard.ZstdCompressor(level=self.level, dict_data=self.zdict)
+        return cctx.compress(data)
+
+def train_exif_dictionary(files, exif_pool, out_path, dict_size=64 * 1024, max_samples=2000):
+    """Trains a zstd dictionary on the exiftool JSON of up to `max_samples` files."""
+    if zstandard is None:
+        raise RuntimeError("Dictionary training needs the 'zstandard' package")
+    # Reservoir sample so any size of archive can be streamed through
+    sample_files = []
+    for n, path in enumerate(files):
+        if n < max_samples:
+            sample_files.append(path)
+        elif (j := random.randrange(n + 1)) < max_samples:
+            sample_files[j] = path
+
+    samples = []
+    for i in range(0, len(sample_files), 32):
+        for exif in exif_pool.get_metadata_batch(sample_files[i:i + 32]).values():
+            if 'Error' not in exif:
+                samples.append(json.dumps(exif_fields.prune(exif)).encode())
 
-def upload_batch(s3, batch_data, user_sub, bucket_name):
-    batch_id = uuid.uuid4().hex
-    payload = {"user_id": user_sub, "images": batch_data}
+    zdict = zstandard.train_dictionary(dict_size, samples)
+    with open(out_path, 'wb') as f:
+        f.write(zdict.as_bytes())
+    return zdict.dict_id(), len(samples)
+
+def serialize_batch(batch_data, user_sub, batch_format="binary"):
+    """Returns (batch_id, body, content_type); the batch id carries the format's extension."""
+    if batch_format == "json":
+        body = json.dumps({"user_id": user_sub, "images": [json_record(r) for r in batch_data]}).encode()
+        return f"{uuid.uuid4().hex}.json", body, "application/json"
+    return f"{uuid.uuid4().hex}.bin", pack_container(user_sub, batch_data), "application/octet-stream"
+
+def upload_batch(s3, batch_data, user_sub, bucket_name, batch_format="binary"):
+    batch_id, body, content_type = serialize_batch(batch_data, user_sub, batch_format)
     s3.put_object(
         Bucket=bucket_name,
-        Key=f"incoming/{user_sub}/{batch_id}.json",
-        Body=json.dumps(payload),
-        ContentType="application/json"
+        Key=batch_key(user_sub, batch_id),
+        Body=body,
+        ContentType=content_type
     )
+    return batch_id
+
+# --- INGESTION MANIFEST ---
+class IngestManifest:
+    """Local SQLite record of every file handed to the pipeline.
+
+    Rows are keyed by absolute path and remember the size/mtime seen at
+    ingest, so a re-run decides "already done" from a stat() and one indexed
+    lookup without opening the RAW. States move extracted -> uploaded
+    (with the batch id) -> confirmed once the processor has consumed the batch,
+    or dead_lettered for files the processor set aside under failed/. Each file
+    also keeps its ordinal in the batch, which is how the processor names them.
+    With `use_hash` a changed size/mtime falls back to a content hash, which
+    also recognises files that were moved or copied.
+    """
+    DONE_STATES = ('uploaded', 'spooled', 'confirmed', 'dead_lettered')
+
+    def __init__(self, db_path, use_hash=False):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.use_hash = use_hash
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                content_hash TEXT,
+                state TEXT NOT NULL,
+                batch_id TEXT,
+                ordinal INTEGER,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS files_batch ON files(batch_id);
+            CREATE INDEX IF NOT EXISTS files_hash ON files(content_hash);
+        """)
+        # Manifests from before ordinals were recorded
+        if 'ordinal' not in {r[1] for r in self.db.execute("PRAGMA table_info(files)")}:
+            self.db.execute("ALTER TABLE files ADD COLUMN ordinal INTEGER")
+
+    @staticmethod
+    def file_hash(path):
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            while chunk := f.read(1024 * 1024):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def fingerprint(self, path):
+        """Returns the (path, size, mtime_ns, hash) tuple the pipeline carries for a file."""
+        st = os.stat(path)
+        return (os.path.abspath(path), st.st_size, st.st_mtime_ns, None)
+
+    def pending(self, fp):
+        """Returns None when `fp` is already ingested, else the fingerprint to carry through the pipeline."""
+        path, size, mtime_ns, _ = fp
+        with self._lock:
+            row = self.db.execute("SELECT size, mtime_ns, state FROM files WHERE path = ?", (path,)).fetchone()
+        if row and row[2] in self.DONE_STATES and (row[0], row[1]) == (size, mtime_ns):
+            return None
+        if not self.use_hash:
+            return fp
+
+        fp = (path, size, mtime_ns, self.file_hash(path))
+        with self._lock:
+            match = self.db.execute(
+                f"SELECT state, batch_id, ordinal FROM files WHERE content_hash = ? AND state IN ({','.join('?' * len(self.DONE_STATES))}) LIMIT 1",
+                (fp[3], *self.DONE_STATES)
+            ).fetchone()
+            if match:
+                # A copy shares the fate of the file that was sent
+                self._upsert([fp], match[0], match[1], [match[2]])
+                return None
+        return fp
+
+    def _upsert(self, fps, state, batch_id=None, ordinals=None):
+        now = time.time()
+        ordinals = ordinals or [None] * len(fps)
+        self.db.executemany(
+            """INSERT INTO files (path, size, mtime_ns, content_hash, state, batch_id, ordinal, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns,
+                   content_hash = COALESCE(excluded.content_hash, files.content_hash),
+                   state = excluded.state, batch_id = excluded.batch_id, ordinal = excluded.ordinal,
+                   updated_at = excluded.updated_at""",
+            [(p, sz, mt, h, state, batch_id, o, now) for (p, sz, mt, h), o in zip(fps, ordinals)]
+        )
+        self.db.commit()
+
+    def mark_extracted(self, fps):
+        with self._lock:
+            self._upsert(fps, 'extracted')
+
+    def mark_uploaded(self, fps, batch_id):
+        """`fps` are in batch order, so their positions are the processor's ordinals."""
+        with self._lock:
+            self._upsert(fps, 'uploaded', batch_id, range(len(fps)))
+
+    def mark_spooled(self, fps, batch_id):
+        with self._lock:
+            self._upsert(fps, 'spooled', batch_id, range(len(fps)))
+
+    def uploaded_batches(self):
+        with self._lock:
+            return [r[0] for r in self.db.execute("SELECT DISTINCT batch_id FROM files WHERE state = 'uploaded'")]
+
+    def mark_confirmed(self, batch_id, marker=None):
+        """Confirms a consumed batch, except the files its `.dead` marker lists. Returns those paths.
+
+        Files are matched by batch ordinal (rows from older manifests, which lack
+        one, by filename); a marker without ordinals sets the whole batch aside.
+        """
+        with self._lock:
+            now = time.time()
+            rows = self.db.execute("SELECT path, ordinal FROM files WHERE batch_id = ? AND state = 'uploaded'", (batch_id,)).fetchall()
+            dead = []
+            if marker:
+                ordinals, names = marker.get('ordinals'), set(marker.get('filenames') or ())
+                dead = [p for p, o in rows if ordinals is None or (o in ordinals if o is not None else os.path.basename(p) in names)]
+            self.db.executemany("UPDATE files SET state = 'dead_lettered', updated_at = ? WHERE path = ?", [(now, p) for p in dead])
+            self.db.execute(
+                "UPDATE files SET state = 'confirmed', updated_at = ? WHERE batch_id = ? AND state = 'uploaded'",
+                (now, batch_id)
+            )
+            self.db.commit()
+            return dead
+
+    def close(self):
+        with self._lock:
+            self.db.close()
 
-def get_exif_with_tool(file_path):
+# --- EXIFTOOL WORKER POOL ---
+class ExifToolError(Exception):
+    pass
+
+class ExifToolWorker:
+    """A single long-lived `exiftool -stay_open True -@ -` process.
+
+    Each request is written to stdin as one argument per line followed by
+    `-execute{n}`. exiftool terminates its reply with `{ready{n}}`, so a
+    late answer to a timed-out request can never be mistaken for the next one.
+    """
+    def __init__(self, executable="exiftool", timeout=30):
+        self.executable = executable
+        self.timeout = timeout
+        self.proc = None
+        self._seq = 0
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            [self.executable, "-stay_open", "True", "-@", "-", "-common_args", "-json", "-G"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+
+    def execute(self, paths):
+        """Runs one exiftool command over `paths` and returns the parsed JSON records."""
+        if not self.alive():
+            self.start()
+        self._seq += 1
+        marker = f"{{ready{self._seq}}}".encode()
+        request = "".join(f"{p}\n" for p in paths) + f"-execute{self._seq}\n"
+        try:
+            self.proc.stdin.write(request.encode())
+            self.proc.stdin.flush()
+            out = self._read_until(marker, self.timeout * max(1, len(paths)))
+        except (OSError, ExifToolError, TimeoutError):
+            self.kill()
+            raise
+        return json.loads(out) if out.strip() else []
+
+    def _read_until(self, marker, timeout):
+        fd = self.proc.stdout.fileno()
+        deadline = time.monotonic() + timeout
+        buf = bytearray()
+        while True:
+            idx = buf.find(marker, max(0, len(buf) - 65536 - len(marker)))
+            if idx != -1:
+                return bytes(buf[:idx])
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"exiftool did not answer within {timeout}s")
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready: continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise ExifToolError("exiftool exited unexpectedly")
+            buf.extend(chunk)
+
+    def kill(self):
+        if self.proc is None: return
+        try:
+            self.proc.kill()
+            self.proc.wait(timeout=5)
+        except Exception:
+            pass
+        self.proc = None
+
+    def close(self):
+        if not self.alive():
+            self.proc = None
+            return
+        try:
+            self.proc.stdin.write(b"-stay_open\nFalse\n")
+            self.proc.stdin.flush()
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+            self.proc = None
+        except Exception:
+            self.kill()
+
+class ExifToolPool:
+    """Fixed set of ExifToolWorkers shared by the ingestion threads.
+
+    A worker is checked out for the duration of one request. Workers that
+    crash or time out are killed and transparently restarted on their next use.
+    """
+    def __init__(self, size, executable="exiftool", timeout=30):
+        self._workers = [ExifToolWorker(executable, timeout) for _ in range(max(1, size))]
+        self._idle = queue.Queue()
+        for w in self._workers:
+            self._idle.put(w)
+
+    def get_metadata(self, file_path):
+        return self.get_metadata_batch([file_path])[file_path]
+
+    def get_metadata_batch(self, file_paths):
+        """Bulk mode: extracts metadata for many files with a single exiftool call."""
+        worker = self._idle.get()
+        try:
+            try:
+                records = worker.execute(file_paths)
+            except ExifToolError:
+                # One restart per request; a file that kills exiftool twice is reported as an error
+                records = worker.execute(file_paths)
+        except Exception as e:
+            return {fp: {"SourceFile": os.path.basename(fp), "Error": str(e)} for fp in file_paths}
+        finally:
+            self._idle.put(worker)
+
+        by_source = {r.get('SourceFile'): r for r in records}
+        return {
+            fp: by_source.get(fp) or {"SourceFile": os.path.basename(fp), "Error": "No metadata returned"}
+            for fp in file_paths
+        }
+
+    def close(self):
+        for w in self._workers:
+            w.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def get_exif_with_tool(file_path, exif_pool=None):
+    if exif_pool is not None:
+        return exif_pool.get_metadata(file_path)
     try:
         cmd = ['exiftool', '-json', '-G', file_path]
         result = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
@@ -58,40 +441,502 @@ def get_exif_with_tool(file_path):
     except Exception as e:
         return {"SourceFile": os.path.basename(file_path), "Error": str(e)}
 
-def process_image(file_path, debug=False, force=False):
-    fname = os.path.basename(file_path)
-    if debug: print(f"[DEBUG] Processing: {fname} {'(FORCE)' if force else ''}")
-
+# --- DECODE STRATEGY ---
+def open_embedded_preview(raw):
+    """Returns (lazy PIL image, source) for the preview LibRaw embeds, or (None, None)."""
     try:
-        exif_dict = get_exif_with_tool(file_path)
-        with rawpy.imread(file_path) as raw:
-            try:
-                thumb = raw.extract_thumb()
-                img = Image.open(io.BytesIO(thumb.data)) if thumb.format == rawpy.ThumbFormat.JPEG else Image.fromarray(thumb.data)
-            except:
-                img = Image.fromarray(raw.postprocess(use_camera_wb=True, half_size=True, no_auto_bright=True))
+        thumb = raw.extract_thumb()
+    except Exception:
+        return None, None
+    if thumb.format == rawpy.ThumbFormat.JPEG:
+        # Image.open only parses the header; pixels are decoded on first access
+        return Image.open(io.BytesIO(thumb.data)), "embedded-jpeg"
+    return Image.fromarray(thumb.data), "embedded-bitmap"
 
-            img.thumbnail((2048, 2048), Image.Resampling.LANCZOS)
-            buf = io.BytesIO()
-            img.save(buf, format="JPEG", quality=85)
-            final_thumb = buf.getvalue()
+def fit_size(size, target):
+    """Size of `size` scaled to fit a target x target box, rounded up."""
+    longest = max(size)
+    if longest <= target: return size
+    return (-(-size[0] * target // longest), -(-size[1] * target // longest))
 
-        return {
-            "filename": fname,
-            "force_reprocess": force,
-            "exif": base64.b64encode(brotli.compress(json.dumps(exif_dict).encode())).decode(),
-            "thumb": base64.b64encode(brotli.compress(final_thumb)).decode()
+def decode_preview(file_path, target=2048, min_thumb=1024, quality=85):
+    """Decodes the cheapest source that covers `target` and returns (jpeg_bytes, info).
+
+    An embedded JPEG preview is decoded in draft mode, which lets libjpeg
+    drop DCT coefficients and decode straight to 1/2, 1/4 or 1/8 scale, so a
+    full-resolution 45MP preview costs about a 2MP decode. An embedded preview
+    smaller than `target` but at least `min_thumb` is still preferred over a
+    demosaic; only a missing or tiny preview falls back to LibRaw's half-size
+    postprocess. `info` records which path was taken, how many pixels were
+    decoded and the time spent in each step. Module-level so it can run in
+    the decode process pool.
+    """
+    t0 = time.perf_counter()
+    with rawpy.imread(file_path) as raw:
+        img, source = open_embedded_preview(raw)
+        if img is not None and max(img.size) < min(target, min_thumb):
+            img, source = None, None
+
+        embedded_size = img.size if img is not None else None
+        if source == "embedded-jpeg":
+            img.draft('RGB', fit_size(img.size, target))
+        elif img is None:
+            img = Image.fromarray(raw.postprocess(use_camera_wb=True, half_size=True, no_auto_bright=True))
+            source = "half-size-demosaic"
+            embedded_size = img.size
+
+        img.load()
+        decoded = img.size
+        t1 = time.perf_counter()
+        img.thumbnail((target, target), Image.Resampling.LANCZOS)
+        t2 = time.perf_counter()
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=quality)
+        t3 = time.perf_counter()
+
+    info = {
+        "source": source,
+        "decoded": decoded,
+        "scale": round(decoded[0] / embedded_size[0], 4),
+        "pixels": decoded[0] * decoded[1],
+        "output": img.size,
+        "timings": {"decode": t1 - t0, "resize": t2 - t1, "encode": t3 - t2},
+    }
+    return buf.getvalue(), info
+
+def encode_record(fname, exif_dict, jpeg_bytes, force=False, codecs=DEFAULT_CODECS):
+    return {
+        "filename": fname,
+        "force_reprocess": force,
+        "fields": {
+            # Only keys the processor resolves or stores are shipped
+            "exif": (codecs['exif'], CODECS[codecs['exif']](json.dumps(exif_fields.prune(exif_dict)).encode())),
+            "thumb": (codecs['thumb'], CODECS[codecs['thumb']](jpeg_bytes)),
         }
+    }
+
+def process_image(file_path, debug=False, force=False, exif_pool=None, exif_dict=None, codecs=DEFAULT_CODECS, preview_cfg=None):
+    fname = os.path.basename(file_path)
+    if debug: print(f"[DEBUG] Processing: {fname} {'(FORCE)' if force else ''}")
+
+    try:
+        if exif_dict is None:
+            exif_dict = get_exif_with_tool(file_path, exif_pool)
+        jpeg, info = decode_preview(file_path, **(preview_cfg or {}))
+        if debug: print(f"[DEBUG] {fname}: {info['source']} decoded at {info['decoded'][0]}x{info['decoded'][1]}")
+        return encode_record(fname, exif_dict, jpeg, force, codecs)
     except Exception as e:
         print(f"❌ Error on {fname}: {e}")
         return None
 
+# --- DISCOVERY ---
+def matches_any(rel_path, patterns):
+    return any(fnmatch.fnmatchcase(rel_path, p) for p in patterns)
+
+def discover_files(root, extensions, include=(), exclude=(), workers=8, depth=1024):
+    """Streams matching files under `root` as they are found.
+
+    Directories are listed with os.scandir by `workers` threads, so on a NAS
+    many listings are in flight at once, and paths are handed out through a
+    bounded queue, so memory stays flat however large the tree is.
+    `include`/`exclude` are glob patterns matched against the path relative
+    to `root` (`*` also crosses `/`); excluded directories are not entered.
+    """
+    dirs, found = queue.Queue(), queue.Queue(depth)
+    lock = threading.Lock()
+    pending = [1]
+    dirs.put(root)
+
+    def walk():
+        while (path := dirs.get()) is not _END:
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        rel = os.path.relpath(entry.path, root).replace(os.sep, '/')
+                        if exclude and matches_any(rel, exclude): continue
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                with lock: pending[0] += 1
+                                dirs.put(entry.path)
+                            elif entry.name.lower().endswith(extensions) and (not include or matches_any(rel, include)):
+                                found.put(entry.path)
+                        except OSError:
+                            continue
+            except OSError as e:
+                print(f"⚠️ Cannot list {path}: {e}")
+
+            with lock:
+                pending[0] -= 1
+                finished = pending[0] == 0
+            if finished:
+                for _ in range(workers): dirs.put(_END)
+                found.put(_END)
+
+    for i in range(workers):
+        threading.Thread(target=walk, name=f"scandir-{i}", daemon=True).start()
+    while (path := found.get()) is not _END:
+        yield path
+
+# --- INGESTION PIPELINE ---
+_END = object()
+
+class PipelineStage:
+    """Runs `fn` on `workers` threads between two bounded queues.
+
+    Jobs are dicts that `fn` fills in place. When `batch` is set the stage
+    hands `fn` a list of up to `batch` jobs that were already waiting. A job whose
+    step raises is marked with `error` and forwarded untouched, so later
+    stages skip it and the batcher still counts it.
+    """
+    def __init__(self, name, fn, workers, inbox, outbox, batch=None):
+        self.name, self.fn, self.inbox, self.outbox, self.batch = name, fn, inbox, outbox, batch
+        self._live = workers
+        self._lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True) for i in range(workers)]
+
+    def start(self):
+        for t in self.threads: t.start()
+        return self
+
+    def join(self):
+        for t in self.threads: t.join()
+
+    def _take(self):
+        jobs = [self.inbox.get()]
+        while len(jobs) < (self.batch or 1) and jobs[-1] is not _END:
+            try:
+                jobs.append(self.inbox.get_nowait())
+            except queue.Empty:
+                break
+        return jobs
+
+    def _run(self):
+        while True:
+            jobs = self._take()
+            done = jobs[-1] is _END
+            if done: jobs.pop()
+
+            todo = [j for j in jobs if not j.get('error')]
+            if todo:
+                try:
+                    self.fn(todo if self.batch else todo[0])
+                except Exception as e:
+                    for j in todo: j['error'] = f"{self.name}: {e}"
+            for j in jobs:
+                self.outbox.put(j)
+
+            if done:
+                # Let sibling workers see the end marker too
+                self.inbox.put(_END)
+                break
+
+        with self._lock:
+            self._live -= 1
+            last = self._live == 0
+        if last: self.outbox.put(_END)
+
+class UploadError(Exception):
+    pass
+
+class BatchUploader:
+    """Uploads batches from several threads through one shared Cognito identity.
+
+    The identity credentials are renewed `refresh_margin` seconds before they
+    expire rather than after the first ExpiredToken. Throttling and transient
+    network errors are retried with full-jitter exponential backoff; a batch
+    that still cannot be sent is written to `spool_dir` and sent again by
+    replay_spool() on the next run.
+    """
+    AUTH_CODES = {'ExpiredToken', 'ExpiredTokenException', 'CredentialsError', 'InvalidToken'}
+    RETRY_CODES = {
+        'SlowDown', 'Throttling', 'ThrottlingException', 'RequestTimeout',
+        'InternalError', 'ServiceUnavailable', '500', '502', '503', '504'
+    }
+    NETWORK_ERRORS = (EndpointConnectionError, ConnectionClosedError, ReadTimeoutError, ConnectTimeoutError)
+    # Failures worth spooling for a later run; anything else is a bug and is raised
+    SPOOL_ERRORS = (ClientError, BotoCoreError, ConnectionError, UploadError)
+
+    def __init__(self, config, batch_format="binary", upload_cfg=None):
+        upload_cfg = upload_cfg or {}
+        self.config = config
+        self.bucket = config['aws']['raw_source_s3_bucket']
+        self.batch_format = batch_format
+        self.max_attempts = upload_cfg.get('max_attempts', 6)
+        self.backoff_base = upload_cfg.get('backoff_base', 0.5)
+        self.backoff_cap = upload_cfg.get('backoff_cap', 30)
+        self.refresh_margin = upload_cfg.get('refresh_margin', 300)
+        self.spool_dir = os.path.expanduser(upload_cfg.get('spool_dir', '~/.carnus/spool'))
+        self._lock = threading.Lock()
+        self.s3, self.user_sub, self.expires_at = None, None, 0
+        self._refresh()
+
+    def _refresh(self):
+        aws = self.config['aws']
+        c, _, self.user_sub = get_identity_credentials(self.config)
+        session = boto3.Session(
+            aws_access_key_id=c['AccessKeyId'],
+            aws_secret_access_key=c['SecretKey'],
+            aws_session_token=c['SessionToken'],
+            region_name=aws['region']
+        )
+        # Retries are handled here, so botocore should make a single attempt
+        self.s3 = session.client('s3', config=Config(retries={'mode': 'standard', 'max_attempts': 1}))
+        expiration = c.get('Expiration')
+        self.expires_at = expiration.timestamp() if expiration else time.time() + 3600
+
+    def client(self, stale=None):
+        """Returns a client whose credentials outlive the refresh margin.
+
+        Passing the client that just hit an auth error forces a refresh, but
+        only the first thread to report it re-authenticates.
+        """
+        with self._lock:
+            if self.s3 is stale or time.time() > self.expires_at - self.refresh_margin:
+                self._refresh()
+            return self.s3
+
+    def _put(self, batch_id, body, content_type):
+        s3 = self.client()
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                s3.put_object(Bucket=self.bucket, Key=batch_key(self.user_sub, batch_id), Body=body, ContentType=content_type)
+                return
+            except ClientError as e:
+                code = e.response['Error']['Code']
+                if code in self.AUTH_CODES:
+                    s3 = self.client(stale=s3)
+                    continue
+                if code not in self.RETRY_CODES or attempt == self.max_attempts: raise
+            except self.NETWORK_ERRORS:
+                if attempt == self.max_attempts: raise
+            time.sleep(random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt)))
+            s3 = self.client()
+        raise UploadError(f"Gave up on {batch_id} after {self.max_attempts} attempts")
+
+    def send(self, records, files=()):
+        """Uploads a batch, spooling it on persistent failure. Returns (batch_id, spooled)."""
+        batch_id, body, content_type = serialize_batch(records, self.user_sub, self.batch_format)
+        try:
+            self._put(batch_id, body, content_type)
+            return batch_id, False
+        except self.SPOOL_ERRORS as e:
+            print(f"⚠️ Upload of {batch_id} failed ({e}); spooled for replay.")
+            self._spool(batch_id, body, content_type, files)
+            return batch_id, True
+
+    def spool(self, records, files=()):
+        """Writes a batch straight to the spool without trying S3. Returns its batch id."""
+        batch_id, body, content_type = serialize_batch(records, self.user_sub, self.batch_format)
+        self._spool(batch_id, body, content_type, files)
+        return batch_id
+
+    def _spool(self, batch_id, body, content_type, files):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        path = os.path.join(self.spool_dir, batch_id)
+        with open(path + ".tmp", 'wb') as f:
+            f.write(body)
+        os.replace(path + ".tmp", path)
+        with open(path + ".meta.tmp", 'w') as f:
+            json.dump({"content_type": content_type, "files": list(files)}, f)
+        os.replace(path + ".meta.tmp", path + ".meta")
+
+    def replay_spool(self):
+        """Sends every spooled batch. Yields (batch_id, files) for each one delivered."""
+        if not os.path.isdir(self.spool_dir): return
+        for name in sorted(os.listdir(self.spool_dir)):
+            if not name.endswith(".meta"): continue
+            batch_id = name[:-len(".meta")]
+            path = os.path.join(self.spool_dir, batch_id)
+            with open(path + ".meta") as f:
+                meta = json.load(f)
+            with open(path, 'rb') as f:
+                body = f.read()
+            try:
+                self._put(batch_id, body, meta['content_type'])
+            except self.SPOOL_ERRORS as e:
+                print(f"⚠️ Spooled batch {batch_id} still failing: {e}")
+                continue
+            os.remove(path + ".meta")
+            os.remove(path)
+            yield batch_id, [tuple(fp) for fp in meta['files']]
+
+    def ensure_dictionary(self, codec):
+        """Uploads the EXIF dictionary once so the processor can decode batches that use it."""
+        key = dictionary_key(self.user_sub, codec.dict_id)
+        try:
+            self.client().head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ['404', 'NoSuchKey', 'NotFound']: raise
+            self.client().put_object(Bucket=self.bucket, Key=key, Body=codec.data, ContentType="application/octet-stream")
+
+    def batch_consumed(self, batch_id):
+        """Returns False while the blob exists, else its `.dead` marker ({} when there is none).
+
+        The processor deletes a batch blob once it has been ingested. When it set
+        images aside it first writes `<blob>.dead` listing their ordinals and
+        filenames (both None when the whole blob was quarantined).
+        """
+        key = batch_key(self.user_sub, batch_id)
+        try:
+            self.client().head_object(Bucket=self.bucket, Key=key)
+            return False
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ['404', 'NoSuchKey', 'NotFound']: raise
+        try:
+            marker = json.loads(self.client().get_object(Bucket=self.bucket, Key=key + ".dead")['Body'].read())
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']: return {}
+            raise
+        return marker
+
+    def clear_dead_marker(self, batch_id):
+        """Deletes a batch's `.dead` marker once the manifest has recorded it."""
+        self.client().delete_object(Bucket=self.bucket, Key=batch_key(self.user_sub, batch_id) + ".dead")
+
+def batch_codecs(ingest_cfg):
+    if ingest_cfg.get('batch_format', 'binary') == 'json':
+        return {'exif': 'br', 'thumb': 'br'}
+    codecs = {**DEFAULT_CODECS, **ingest_cfg.get('codecs', {})}
+    if ZstdDictCodec.name in CODECS:
+        codecs['exif'] = ZstdDictCodec.name
+    return codecs
+
+def run_pipeline(files, ingest_cfg, uploader, manifest=None, debug=False, force=False):
+    """discover -> exif -> decode (process pool) -> compress -> batch -> upload
+
+    Every hand-off is a bounded queue, so a slow stage back-pressures the ones
+    before it instead of buffering the whole shoot in memory.
+    """
+    pipe_cfg = ingest_cfg.get('pipeline', {})
+    def workers(key, default):
+        return 1 if debug else max(1, pipe_cfg.get(key, default))
+
+    depth = pipe_cfg.get('queue_size', 64)
+    q_exif, q_decode, q_compress, q_batch, q_upload = (queue.Queue(depth) for _ in range(5))
+    q_uploaded = queue.Queue()
+    batch_size, max_bytes = ingest_cfg.get('batch_size', 20), 5 * 1024 * 1024
+    codecs = batch_codecs(ingest_cfg)
+    preview_cfg = ingest_cfg.get('preview', {})
+    decode_sources, decoded_pixels = Counter(), 0
+
+    exif_workers = workers('exif_workers', ingest_cfg.get('max_workers', 4))
+    exif_pool = ExifToolPool(exif_workers, ingest_cfg.get('exiftool_path', 'exiftool'), ingest_cfg.get('exiftool_timeout', 30))
+    decode_workers = workers('decode_workers', os.cpu_count() or 4)
+    decode_pool = ProcessPoolExecutor(max_workers=decode_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def extract_exif(jobs):
+        exif = exif_pool.get_metadata_batch([j['path'] for j in jobs])
+        for j in jobs: j['exif'] = exif[j['path']]
+        # Recorded as each exiftool call returns, so the manifest shows files still being decoded
+        if manifest: manifest.mark_extracted([j['fingerprint'] for j in jobs if j['fingerprint'] and 'Error' not in j['exif']])
+
+    def decode(job):
+        if debug: print(f"[DEBUG] Processing: {os.path.basename(job['path'])} {'(FORCE)' if force else ''}")
+        job['jpeg'], job['decode_info'] = decode_pool.submit(decode_preview, job['path'], **preview_cfg).result()
+        if debug:
+            info = job['decode_info']
+            print(f"[DEBUG] {os.path.basename(job['path'])}: {info['source']} decoded at {info['decoded'][0]}x{info['decoded'][1]}")
+
+    def compress(job):
+        job['record'] = encode_record(os.path.basename(job['path']), job.pop('exif'), job.pop('jpeg'), force, codecs)
+
+    def upload(job):
+        job['batch_id'], spooled = uploader.send(job['records'], job['files'])
+        if manifest: (manifest.mark_spooled if spooled else manifest.mark_uploaded)(job['files'], job['batch_id'])
+
+    stages = [
+        PipelineStage("exif", extract_exif, exif_workers, q_exif, q_decode,
+                      batch=max(1, ingest_cfg.get('exif_batch_size', 1))),
+        PipelineStage("decode", decode, decode_workers, q_decode, q_compress),
+        PipelineStage("compress", compress, workers('compress_workers', 2), q_compress, q_batch),
+        PipelineStage("upload", upload, workers('upload_workers', 2), q_upload, q_uploaded),
+    ]
+
+    def discover():
+        found = 0
+        for f in files:
+            found += 1
+            if streaming: progress.total = found
+            try:
+                fp = manifest.fingerprint(f) if manifest else None
+                if fp and not force:
+                    fp = manifest.pending(fp)
+                    if fp is None:
+                        progress.update(1)
+                        continue
+            except OSError as e:
+                print(f"❌ Error on {os.path.basename(f)}: {e}")
+                progress.update(1)
+                continue
+            q_exif.put({'path': f, 'fingerprint': fp})
+        progress.total = found
+        progress.refresh()
+        q_exif.put(_END)
+
+    enqueue_timeout = ingest_cfg.get('upload', {}).get('enqueue_timeout', 10)
+
+    def send(batch_jobs):
+        fps = [j['fingerprint'] for j in batch_jobs if j['fingerprint']]
+        records = [j['record'] for j in batch_jobs]
+        try:
+            q_upload.put({'records': records, 'files': fps}, timeout=enqueue_timeout)
+        except queue.Full:
+            # Uploads are falling behind; park the batch on disk rather than stall decoding
+            batch_id = uploader.spool(records, fps)
+            if manifest: manifest.mark_spooled(fps, batch_id)
+
+    # Discovery may still be running; the bar's total grows as files are found
+    streaming = not isinstance(files, (list, tuple))
+    with exif_pool, decode_pool, tqdm(total=None if streaming else len(files), unit="file") as progress:
+        for stage in stages: stage.start()
+        threading.Thread(target=discover, name="discover", daemon=True).start()
+
+        current_batch, current_batch_bytes = [], 0
+        while (job := q_batch.get()) is not _END:
+            progress.update(1)
+            if job.get('error'):
+                print(f"❌ Error on {os.path.basename(job['path'])}: {job['error']}")
+                continue
+            decode_sources[job['decode_info']['source']] += 1
+            decoded_pixels += job['decode_info']['pixels']
+            current_batch.append(job)
+            current_batch_bytes += record_size(job['record'])
+
+            if len(current_batch) >= batch_size or current_batch_bytes >= max_bytes:
+                send(current_batch)
+                current_batch, current_batch_bytes = [], 0
+
+        if current_batch: send(current_batch)
+        q_upload.put(_END)
+        stages[-1].join()
+
+    if decode_sources:
+        paths = ", ".join(f"{src} {n}" for src, n in decode_sources.most_common())
+        print(f"🖼️  Decode paths: {paths} | {decoded_pixels / sum(decode_sources.values()) / 1e6:.1f} MP decoded per file")
+
+    failed = [j for j in iter(q_uploaded.get_nowait, _END) if j.get('error')]
+    for j in failed:
+        print(f"❌ Upload failed for a batch of {len(j['records'])} images: {j['error']}")
+    return failed
+
+def replay_spool(uploader, manifest=None):
+    replayed = 0
+    for batch_id, fps in uploader.replay_spool():
+        if manifest: manifest.mark_uploaded(fps, batch_id)
+        replayed += 1
+    if replayed: print(f"📤 Replayed {replayed} spooled batches.")
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("directory", nargs="?", default="./")
     parser.add_argument("--debug", action="store_true")
     parser.add_argument("--force", action="store_true")
-    parser.add_argument("--skip", type=int, default=0)
+    parser.add_argument("--manifest", help="Ingestion manifest (default: ingestion.manifest_path)")
+    parser.add_argument("--no-manifest", action="store_true", help="Ignore the manifest and send every file")
+    parser.add_argument("--confirm", action="store_true", help="Mark uploaded batches the processor has consumed as confirmed, then exit")
+    parser.add_argument("--train-dictionary", metavar="OUT", help="Train an EXIF compression dictionary from the directory's files, then exit")
+    parser.add_argument("--include", action="append", default=[], metavar="GLOB", help="Only ingest paths matching this glob (repeatable)")
+    parser.add_argument("--exclude", action="append", default=[], metavar="GLOB", help="Skip paths or directories matching this glob (repeatable)")
     args = parser.parse_args()
 
     config = load_config()
@@ -104,33 +949,53 @@ def main():
         print("Starting in 5 seconds... (Ctrl+C to abort)")
         time.sleep(5)
 
-    s3, _, user_sub = get_authenticated_session(config)
     raw_extensions = tuple(ext.lower() for ext in ingest_cfg.get('extensions', []))
-    
-    files = [os.path.join(r, f) for r, _, fs in os.walk(args.directory) for f in fs if f.lower().endswith(raw_extensions)]
-    if args.skip > 0: files = files[args.skip:]
+    files = discover_files(
+        args.directory, raw_extensions,
+        include=ingest_cfg.get('include', []) + args.include,
+        exclude=ingest_cfg.get('exclude', []) + args.exclude,
+        workers=ingest_cfg.get('pipeline', {}).get('discover_workers', 8)
+    )
 
-    current_batch, current_batch_bytes = [], 0
-    workers = 1 if debug_mode else ingest_cfg.get('max_workers', 4)
-    batch_size, max_bytes = ingest_cfg.get('batch_size', 20), 5 * 1024 * 1024
+    if args.train_dictionary:
+        with ExifToolPool(1, ingest_cfg.get('exiftool_path', 'exiftool'), ingest_cfg.get('exiftool_timeout', 30)) as exif_pool:
+            dict_id, samples = train_exif_dictionary(files, exif_pool, args.train_dictionary)
+        print(f"📚 Dictionary {dict_id} trained on {samples} files -> {args.train_dictionary}")
+        print(f"   Set ingestion.exif_dictionary: \"{args.train_dictionary}\" to use it.")
+        return
 
-    with ThreadPoolExecutor(max_workers=workers) as executor:
-        for res in tqdm(executor.map(lambda f: process_image(f, debug_mode, force_mode), files), total=len(files)):
-            if not res: continue
-            current_batch.append(res)
-            current_batch_bytes += len(json.dumps(res))
+    uploader = BatchUploader(config, ingest_cfg.get('batch_format', 'binary'), ingest_cfg.get('upload', {}))
+    if ingest_cfg.get('exif_dictionary') and ingest_cfg.get('batch_format', 'binary') == 'binary':
+        codec = CODECS[ZstdDictCodec.name] = ZstdDictCodec(ingest_cfg['exif_dictionary'])
+        uploader.ensure_dictionary(codec)
+    
+    manifest = None
+    if not args.no_manifest:
+        manifest_path = args.manifest or ingest_cfg.get('manifest_path', '~/.carnus/manifest.sqlite')
+        manifest = IngestManifest(os.path.expanduser(manifest_path), ingest_cfg.get('manifest_hash', False))
 
-            if len(current_batch) >= batch_size or current_batch_bytes >= max_bytes:
-                try:
-                    upload_batch(s3, current_batch, user_sub, config['aws']['raw_source_s3_bucket'])
-                except ClientError as e:
-                    if e.response['Error']['Code'] in ['ExpiredToken', 'CredentialsError']:
-                        s3, _, user_sub = get_authenticated_session(config)
-                        upload_batch(s3, current_batch, user_sub, config['aws']['raw_source_s3_bucket'])
-                    else: raise e
-                current_batch, current_batch_bytes = [], 0
+    if args.confirm:
+        if not manifest: parser.error("--confirm needs a manifest")
+        confirmed, dead = 0, []
+        for batch_id in manifest.uploaded_batches():
+            consumed = uploader.batch_consumed(batch_id)
+            if consumed is False: continue
+            dead += manifest.mark_confirmed(batch_id, consumed)
+            if consumed: uploader.clear_dead_marker(batch_id)
+            confirmed += 1
+        print(f"✅ {confirmed} batches confirmed.")
+        if dead:
+            print(f"🪦 {len(dead)} file(s) were dead-lettered by the processor; replay them by copying failed/ back to incoming/:")
+            for path in dead: print(f"   {path}")
+        return
 
-    if current_batch: upload_batch(s3, current_batch, user_sub, config['aws']['raw_source_s3_bucket'])
+    try:
+        replay_spool(uploader, manifest)
+        failed = run_pipeline(files, ingest_cfg, uploader, manifest, debug_mode, force_mode)
+        replay_spool(uploader, manifest)
+    finally:
+        if manifest: manifest.close()
+    if failed: raise SystemExit(1)
     if debug_mode: print(f"\n✨ Ingestion complete.")
 
 if __name__ == "__main__":
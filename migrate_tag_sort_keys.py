@@ -0,0 +1,89 @@
+"""Rewrites legacy tag posting rows (SK "IMAGE#{id}") to the capture-date key.
+
+Run once after deploying date-ordered galleries, with credentials that can
+scan and write the table (not the Cognito upload identity):
+
+    python migrate_tag_sort_keys.py --table carnus-metadata-xxxxx --dry-run
+    python migrate_tag_sort_keys.py --table carnus-metadata-xxxxx --segments 8
+
+Each row is copied to its new key before the old one is deleted, so an
+interrupted run is finished by running it again. A date-keyed row that already
+exists (the processor rewrote it, or an earlier run copied it) is kept as it
+is, since it may be newer (e.g. carry a GridKey); only the legacy row goes.
+"""
+import os, sys, argparse, threading
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.dynamodb.conditions import Attr
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src", "shared"))
+import carnus_keys
+
+class Tally:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {'scanned': 0, 'migrated': 0, 'kept': 0, 'skipped': 0}
+
+    def add(self, **counts):
+        with self.lock:
+            for k, v in counts.items(): self.counts[k] += v
+
+def copy_row(table, item):
+    """Puts the date-keyed copy unless one exists; returns False when an existing row was kept."""
+    try:
+        table.put_item(Item=item, ConditionExpression="attribute_not_exists(SK)")
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException': raise
+        return False
+
+def migrate_segment(table, segment, segments, tally, dry_run):
+    scan = {
+        # TAG_CLOUD rows have no "#TAG#" in their PK, so only posting rows match
+        'FilterExpression': Attr('PK').contains('#TAG#') & Attr('SK').begins_with(carnus_keys.LEGACY_PREFIX),
+        'Segment': segment, 'TotalSegments': segments
+    }
+    while True:
+        resp = table.scan(**scan)
+        moves, skipped = [], 0
+        for item in resp.get('Items', []):
+            capture_date = item.get('Timestamp')
+            if not capture_date:
+                print(f"⚠️ No capture date, left as is: {item['PK']} {item['SK']}")
+                skipped += 1
+                continue
+            sk = carnus_keys.tag_sort_key(capture_date, item.get('ImageId') or carnus_keys.image_id_of(item['SK']))
+            moves.append(({**item, 'SK': sk, 'GSI1SK': sk}, {'PK': item['PK'], 'SK': item['SK']}))
+        kept = 0
+        if moves and not dry_run:
+            # Every copy is written (or found) before any original is deleted
+            kept = sum(not copy_row(table, new) for new, _ in moves)
+            with table.batch_writer() as batch:
+                for _, old in moves: batch.delete_item(Key=old)
+        tally.add(scanned=resp.get('ScannedCount', 0), migrated=len(moves) - kept, kept=kept, skipped=skipped)
+        if 'LastEvaluatedKey' not in resp: return
+        scan['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+def main():
+    parser = argparse.ArgumentParser(description="Move tag posting rows to capture-date sort keys")
+    parser.add_argument("--table", required=True)
+    parser.add_argument("--region", default=os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION"))
+    parser.add_argument("--segments", type=int, default=4, help="Parallel scan segments")
+    parser.add_argument("--dry-run", action="store_true", help="Count the rows that would move without writing")
+    args = parser.parse_args()
+
+    config = Config(retries={'mode': 'adaptive', 'max_attempts': 10}, max_pool_connections=max(10, args.segments * 2))
+    table = boto3.resource('dynamodb', region_name=args.region, config=config).Table(args.table)
+    tally = Tally()
+    with ThreadPoolExecutor(max_workers=args.segments) as pool:
+        list(pool.map(lambda s: migrate_segment(table, s, args.segments, tally, args.dry_run), range(args.segments)))
+
+    verb = "Would migrate" if args.dry_run else "Migrated"
+    print(f"✅ {verb} {tally.counts['migrated']} tag rows ({tally.counts['scanned']} scanned, "
+          f"{tally.counts['kept']} already date-keyed, {tally.counts['skipped']} skipped).")
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,13 @@
 import json
 import os
 import time
-import boto3
 import urllib.request
 import traceback
 from jose import jwt, jwk
+import carnus_init
 
 # Global cache to persist across warm starts
 JWKS_CACHE = None
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.environ.get('TABLE_NAME', ''))
 
 def handler(event, context):
     global JWKS_CACHE
@@ -80,7 +78,8 @@ def handler(event, context):
 def _check_dynamo_verification(user_id):
     """Real-time fallback for newly verified users with stale JWTs."""
     try:
-        response = table.get_item(
+        # Only stale tokens reach DynamoDB, so most cold starts never build this client
+        response = carnus_init.table(os.environ.get('TABLE_NAME', '')).get_item(
             Key={'PK': f"USER#{user_id}#PROFILE", 'SK': "METADATA"},
             ProjectionExpression="EmailVerified"
         )
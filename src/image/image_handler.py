@@ -1,9 +1,10 @@
 import json
-import boto3
 import os
-from boto3.dynamodb.conditions import Key
+import zlib
 from decimal import Decimal
-from botocore.config import Config
+import carnus_init
+import carnus_metrics
+import carnus_presign
 
 # Handle DynamoDB Numbers (Decimals) for JSON serialization
 class DecimalEncoder(json.JSONEncoder):
@@ -12,23 +13,63 @@ class DecimalEncoder(json.JSONEncoder):
             return int(obj) if obj % 1 == 0 else float(obj)
         return super(DecimalEncoder, self).default(obj)
 
-# Initialize clients with s3v4 for global compatibility
-s3_client = boto3.client('s3', config=Config(signature_version='s3v4'))
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.environ['TABLE_NAME'])
+# Attributes returned by GET /image/{image_id}; EXIF is served separately
+IMAGE_FIELDS = (
+    'UserId', 'ImageId', 'ImageName', 'CaptureDate', 'ProcessedAt', 'Labels', 'Faces', 'Size',
+    'ThumbnailKey', 'GridKey', 'DetailKey', 'Lens', 'CameraModel', 'Make',
+    'GPSLatitude', 'GPSLongitude', 'ISO', 'Aperture', 'ShutterSpeed'
+)
 
+def projection(fields):
+    """Returns get_item kwargs reading only `fields` (aliased, since several are reserved words)."""
+    names = {f"#f{i}": f for i, f in enumerate(fields)}
+    return {'ProjectionExpression': ", ".join(names), 'ExpressionAttributeNames': names}
+
+def get_exif(user_id, image_id):
+    """GET /image/{image_id}/exif: the compressed sidecar, or the inline map on older items."""
+    table = carnus_init.table()
+    with carnus_metrics.stage('DynamoDB'):
+        sidecar = table.get_item(Key={'PK': f"USER#{user_id}#EXIF", 'SK': f"IMAGE#{image_id}"}).get('Item')
+    if sidecar:
+        # Served as stored; no need to round-trip through Python objects
+        body = zlib.decompress(bytes(sidecar['Exif'])).decode()
+    else:
+        # Images processed before the sidecar kept EXIF on the image item
+        with carnus_metrics.stage('DynamoDB'):
+            item = table.get_item(
+                Key={'PK': f"USER#{user_id}#IMAGE", 'SK': f"IMAGE#{image_id}"}, **projection(('ImageId', 'exif'))
+            ).get('Item')
+        if not item:
+            return {
+                "statusCode": 404,
+                "body": json.dumps({"error": "Image not found"})
+            }
+        body = json.dumps(item.get('exif', {}), cls=DecimalEncoder)
+    return {
+        "statusCode": 200,
+        "headers": {
+            "Content-Type": "application/json"
+        },
+        "body": body
+    }
+@carnus_metrics.metered('Image')
 def handler(event, context):
     user_id = event['requestContext']['authorizer']['sub']
     image_id = event.get('pathParameters', {}).get('image_id')
 
     try:
-        # 1. Direct Point Read from User-Image Partition
-        response = table.get_item(
-            Key={
-                'PK': f"USER#{user_id}#IMAGE",
-                'SK': f"IMAGE#{image_id}"
-            }
-        )
+        if event.get('resource', '').endswith('/exif'):
+            return get_exif(user_id, image_id)
+
+        # 1. Direct Point Read from User-Image Partition, projected to what the view returns
+        with carnus_metrics.stage('DynamoDB'):
+            response = carnus_init.table().get_item(
+                Key={
+                    'PK': f"USER#{user_id}#IMAGE",
+                    'SK': f"IMAGE#{image_id}"
+                },
+                **projection(IMAGE_FIELDS)
+            )
         item = response.get('Item')
 
         if not item:
@@ -37,36 +78,25 @@ def handler(event, context):
                 "body": json.dumps({"error": "Image not found"})
             }
 
-        # 2. Generate 15-minute Presigned URLs (900 seconds)
-        thumb_key = item.get('ThumbnailKey')
-        if thumb_key:
-            signed_url = s3_client.generate_presigned_url(
-                'get_object',
-                Params={'Bucket': os.environ['THUMB_BUCKET'], 'Key': thumb_key},
-                ExpiresIn=900
-            )
-            item['DetailUrl'] = signed_url
-            item['ThumbnailUrl'] = signed_url
-        else:
-            item['DetailUrl'] = None
-            item['ThumbnailUrl'] = None
-
-        # 3. Construct Lean Payload
-        # Exclude internal DynamoDB keys and the heavy Exif blob
-        blacklist_prefixes = ('GSI', 'PK', 'SK')
-        blacklist_exact = ('exif',)
-
-        clean_item = {
-            k: v for k, v in item.items()
-            if not k.startswith(blacklist_prefixes) and k not in blacklist_exact
+        # 2. Presigned URLs valid for at least 15 minutes (900 seconds), one per view,
+        # shared with the gallery's tiles so the grid image comes from the browser cache
+        # Images processed before derivatives only have the full preview
+        full_key = item.get('ThumbnailKey')
+        views = {
+            'ThumbnailUrl': item.get('GridKey') or full_key,
+            'DetailUrl': item.get('DetailKey') or full_key,
+            'FullUrl': full_key
         }
+        for field, key in views.items():
+            item[field] = carnus_presign.presigned_get(os.environ['THUMB_BUCKET'], key, expires_in=900)
 
+        # 3. The projection already left out internal keys and EXIF
         return {
             "statusCode": 200,
             "headers": {
                 "Content-Type": "application/json"
             },
-            "body": json.dumps(clean_item, cls=DecimalEncoder)
+            "body": json.dumps(item, cls=DecimalEncoder)
         }
 
     except Exception as e:
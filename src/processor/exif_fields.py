@@ -0,0 +1,81 @@
+import re
+from functools import lru_cache
+
+# --- FIELD SPEC ---
+# Each field resolves to the shortest exiftool key (`-G` "Group:Tag") matching its
+# pattern whose value is non-empty; ties keep exiftool's key order. Keys matching
+# OMIT are never stored in the item's `exif` map.
+FIELD_SPEC = {
+    'date': r'SubSecCreateDate|SubSecDateTimeOriginal|CreateDate|DateTimeOriginal|CreateDate$',
+    'lens': r'LensID$|LensModel$|^Lens$',
+    'model': r'Model$|UniqueCameraModel$',
+    'make': r'Make$|Manufacturer$',
+    'gps_lat': r'GPSLatitude$',
+    'gps_lat_ref': r'GPSLatitudeRef$',
+    'gps_lon': r'GPSLongitude$',
+    'gps_lon_ref': r'GPSLongitudeRef$',
+    'iso': r'ISO$',
+    'aperture': r'FNumber$|Aperture$',
+    'shutter': r'ExposureTime$|ShutterSpeed$',
+}
+OMIT = [r'MakerNote', r'Image', r'Profile', r'Curve', r'Matrix', r'Data', r'Table']
+
+_FIELDS = [(name, re.compile(p, re.I)) for name, p in FIELD_SPEC.items()]
+_OMIT = re.compile('|'.join(OMIT), re.I)
+_UNSAFE = re.compile(r'[^a-zA-Z0-9_]')
+
+# --- PLAN ---
+class Plan:
+    """Key-set specific resolution: candidate keys per field and the keys worth storing."""
+    __slots__ = ('fields', 'kept', 'needed')
+
+    def __init__(self, keys):
+        candidates = {name: [] for name, _ in _FIELDS}
+        self.kept = []
+        for k in keys:
+            for name, pattern in _FIELDS:
+                if pattern.search(k): candidates[name].append(k)
+            if not _OMIT.search(k):
+                self.kept.append((k, _UNSAFE.sub('_', k).strip('_')))
+        # sorted() is stable, so equal lengths keep exiftool's order
+        self.fields = [(name, sorted(c, key=len)) for name, c in candidates.items()]
+        self.needed = {k for _, c in self.fields for k in c}
+
+@lru_cache(maxsize=256)
+def _plan(keys):
+    return Plan(keys)
+
+def plan_for(raw):
+    """Returns the memoized Plan for this record's key set (shared by images from one camera)."""
+    return _plan(tuple(raw))
+
+# --- EXTRACTION ---
+def is_binary(value):
+    return isinstance(value, (bytes, bytearray)) or "(Binary data" in str(value)
+
+def resolve(raw):
+    """Returns {field: stripped string or None} for every FIELD_SPEC entry."""
+    fields = {}
+    for name, candidates in plan_for(raw).fields:
+        fields[name] = None
+        for k in candidates:
+            v = raw[k]
+            if v is None: continue
+            v = str(v).strip()
+            if v:
+                fields[name] = v
+                break
+    return fields
+
+def storable(raw):
+    """Returns the {safe_key: value} map stored on the image item."""
+    return {safe: raw[k] for k, safe in plan_for(raw).kept if not is_binary(raw[k])}
+
+def prune(raw):
+    """Drops keys the processor would neither resolve nor store, keeping exiftool's order."""
+    plan = plan_for(raw)
+    kept = {k for k, _ in plan.kept}
+    return {
+        k: v for k, v in raw.items()
+        if k in plan.needed or (k in kept and not is_binary(v))
+    }
@@ -5,49 +5,371 @@ import io
 import time
 import hashlib
 import threading
-import brotli
+import struct
+import codecs
+import random
+import itertools
+import uuid
+import zlib
 import base64
-from datetime import datetime
+from datetime import datetime, timedelta
 from decimal import Decimal
 from urllib.parse import unquote_plus
-from PIL import Image
-import boto3
-from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Key
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError, BotoCoreError
+import carnus_init
+import carnus_metrics
+import carnus_keys
+import exif_fields
+
+# Only loaded once a batch actually needs them (replayed batches never decode)
+Image = carnus_init.lazy_import('PIL.Image')
+brotli = carnus_init.lazy_import('brotli')
+zstandard = carnus_init.lazy_import('zstandard')
+
+# --- BATCH CONTAINER ---
+# Binary batches written by bulk.py (see pack_container there):
+#   magic "CRNB" | version u8 | 3 reserved bytes | header length u32 BE | header JSON | frames
+# The header indexes every field as {"offset", "length", "codec"} relative to the
+# end of the header, so one image can be sliced out without touching the others.
+# Fields with a "dict" id were compressed with a shared zstd dictionary that
+# bulk.py uploads next to the batches.
+CONTAINER_MAGIC = b"CRNB"
+CONTAINER_VERSIONS = (1,)
+_PREAMBLE = struct.Struct(">4sB3xI")
+
+FIELD_CODECS = {
+    'raw': bytes,
+    'br': lambda data: brotli.decompress(data),
+}
+
+# Trained dictionaries stay loaded for the life of the warm container. A
+# decompressor is not thread-safe, so each worker thread builds one per
+# dictionary and reuses it instead of re-digesting the dictionary per field.
+_DICTIONARIES = {}
+_decompressors = threading.local()
+
+def load_dictionary(s3, bucket, user_id, dict_id):
+    """Returns a decoder for fields compressed with dictionary `dict_id`."""
+    cache_key = (bucket, user_id, dict_id)
+    if cache_key not in _DICTIONARIES:
+        obj = s3.get_object(Bucket=bucket, Key=f"incoming/{user_id}/dictionaries/{dict_id}.zdict")
+        _DICTIONARIES[cache_key] = zstandard.ZstdCompressionDict(obj['Body'].read())
+    zdict = _DICTIONARIES[cache_key]
+
+    def decode(data):
+        mine = _decompressors.__dict__.setdefault('by_dict', {})
+        if cache_key not in mine:
+            mine[cache_key] = zstandard.ZstdDecompressor(dict_data=zdict)
+        return mine[cache_key].decompress(data)
+    return decode
+
+# --- STREAMING PAYLOADS ---
+# Batches are parsed straight off the S3 body and handed out one image at a time,
+# so the handler holds the images in flight rather than the whole batch.
+STREAM_CHUNK = 1 << 20
+
+class StreamReader:
+    """Forward-only reader over a file-like body that tracks its position."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.pos = 0
+
+    def read(self, n=STREAM_CHUNK):
+        data = self.stream.read(n)
+        self.pos += len(data)
+        return data
+
+    def read_exact(self, n):
+        parts, left = [], n
+        while left:
+            chunk = self.read(min(left, STREAM_CHUNK))
+            if not chunk: raise ValueError(f"Batch ended {left} bytes early")
+            parts.append(chunk)
+            left -= len(chunk)
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+
+    def skip_to(self, pos):
+        if pos < self.pos: raise ValueError("Batch fields are not in stream order")
+        while self.pos < pos:
+            self.read_exact(min(pos - self.pos, STREAM_CHUNK))
+
+def _field_decoder(name, f, decoders, dictionaries):
+    if 'dict' not in f:
+        return FIELD_CODECS[f['codec']]
+    if f['dict'] not in decoders:
+        if dictionaries is None: raise ValueError(f"Field {name} needs dictionary {f['dict']}")
+        decoders[f['dict']] = dictionaries(f['dict'])
+    return decoders[f['dict']]
+
+def stream_container(reader, head=b"", dictionaries=None):
+    """Returns (user_id, image iterator) for a binary batch.
+
+    Only the header is read up front; each image's fields are read off the
+    stream when it is reached, so nothing is decompressed until decode_field()
+    is called for that image. `dictionaries(dict_id)` supplies the decoder for
+    dictionary-compressed fields and is called once per id.
+    """
+    magic, version, header_len = _PREAMBLE.unpack(head + reader.read_exact(_PREAMBLE.size - len(head)))
+    if magic != CONTAINER_MAGIC or version not in CONTAINER_VERSIONS:
+        raise ValueError(f"Unsupported batch container (magic={magic!r}, version={version})")
+    header = json.loads(reader.read_exact(header_len))
+    data_start = reader.pos
+
+    def images():
+        decoders = {}
+        entries = sorted(header.get('images', []), key=lambda e: min((f['offset'] for f in e['fields'].values()), default=0))
+        for entry in entries:
+            img = {'filename': entry['filename'], 'force_reprocess': entry.get('force_reprocess', False), 'decoders': {}}
+            for name, f in sorted(entry['fields'].items(), key=lambda kv: kv[1]['offset']):
+                reader.skip_to(data_start + f['offset'])
+                img[name] = reader.read_exact(f['length'])
+                img['decoders'][name] = _field_decoder(name, f, decoders, dictionaries)
+            yield img
+    return header.get('user_id'), images()
+
+_JSON_IMAGES = re.compile(r'"images"\s*:\s*\[')
+_JSON_USER = re.compile(r'"user_id"\s*:\s*("(?:[^"\\]|\\.)*"|null)')
+
+def stream_json(reader, head=b""):
+    """Returns (user_id, image iterator) for a legacy JSON batch.
+
+    The "images" array is decoded one object at a time as the stream arrives.
+    bulk.py writes "user_id" ahead of "images"; it is read from that prefix.
+    """
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = utf8.decode(head)
+    while not (m := _JSON_IMAGES.search(buf)):
+        chunk = reader.read()
+        if not chunk: raise ValueError("Batch has no images array")
+        buf += utf8.decode(chunk)
+    user = _JSON_USER.search(buf, 0, m.start())
+    user_id = json.loads(user.group(1)) if user else None
+
+    def images():
+        decoder = json.JSONDecoder()
+        text, eof = buf[m.end():], False
+        while True:
+            text = text.lstrip().lstrip(',').lstrip()
+            if text.startswith(']'): return
+            try:
+                obj, end = decoder.raw_decode(text)
+            except json.JSONDecodeError:
+                # Most likely an object split across chunks; only fatal once the stream is done
+                if eof: raise
+                # Grow geometrically so a large object is not re-parsed once per chunk
+                chunk = reader.read(max(STREAM_CHUNK, len(text)))
+                eof = not chunk
+                text += utf8.decode(chunk, final=eof)
+                continue
+            text = text[end:]
+            yield obj
+    return user_id, images()
+
+def decode_field(img_data, name):
+    """Returns the decoded bytes of `name` from either batch format."""
+    decoder = img_data.get('decoders', {}).get(name)
+    if decoder is None:
+        # Legacy JSON batch: base64 of brotli
+        return brotli.decompress(base64.b64decode(img_data[name]))
+    return decoder(img_data[name])
+
+def open_payload(stream, dictionaries=None):
+    """Returns (user_id, image iterator) for either batch format read from `stream`."""
+    reader = StreamReader(stream)
+    head = reader.read_exact(len(CONTAINER_MAGIC))
+    if head == CONTAINER_MAGIC:
+        return stream_container(reader, head, dictionaries)
+    return stream_json(reader, head)
 
 # --- IDEMPOTENCY HELPER ---
-def undo_old_metrics(user_id, image_id, table, settings):
-    """Subtracts old counts for tags and stats before re-processing an image."""
-    pk = f"USER#{user_id}#IMAGE"
-    sk = f"IMAGE#{image_id}"
-    try:
-        # Fetch existing tags and size to perform a precise decrement
-        resp = table.get_item(
-            Key={'PK': pk, 'SK': sk}, 
-            ProjectionExpression="Labels, Make, CameraModel, Lens, #sz", 
-            ExpressionAttributeNames={'#sz': 'Size'}
-        )
-        if 'Item' in resp:
-            old = resp['Item']
-            old_tags = set(old.get('Labels', []))
-            old_tags.update([old.get('Make'), old.get('CameraModel'), old.get('Lens')])
-            
-            # Revert Tag Cloud
-            for tag in {t for t in old_tags if t and t != 'Unknown'}:
-                table.update_item(
-                    Key={'PK': f"USER#{user_id}#TAG_CLOUD", 'SK': f'TAG#{tag}'},
-                    UpdateExpression="ADD #cnt :dec",
-                    ExpressionAttributeNames={'#cnt': 'Count'},
-                    ExpressionAttributeValues={':dec': -1}
-                )
-            # Revert Profile Stats
-            table.update_item(
-                Key={'PK': f"USER#{user_id}#PROFILE", 'SK': 'METADATA'},
-                UpdateExpression="ADD StorageBytesUsed :sz, ImageCount :inc",
-                ExpressionAttributeValues={':sz': -old.get('Size', 0), ':inc': -1}
-            )
-    except Exception as e:
-        if settings.get('debug'): print(f"⚠️ [UNDO] Reversion failed: {e}")
+# Force-reprocessing diffs the stored image against the new result: only the net
+# counter change is recorded, vanished tag rows are deleted and new ones written,
+# all in one transaction guarded on the ProcessedAt that was read.
+def previous_metrics(user_id, image_id, table):
+    """Returns {'tags', 'size', 'processed_at', 'grid_key'} for the stored image, or None if there is none.
+
+    Read errors propagate, so the image is retried instead of taking the new-image path.
+    """
+    resp = table.get_item(
+        Key={'PK': f"USER#{user_id}#IMAGE", 'SK': f"IMAGE#{image_id}"},
+        ProjectionExpression="Labels, Make, CameraModel, Lens, #sz, ProcessedAt, GridKey",
+        ExpressionAttributeNames={'#sz': 'Size'}
+    )
+    if 'Item' not in resp: return None
+    old = resp['Item']
+    old_tags = set(old.get('Labels', []))
+    old_tags.update([old.get('Make'), old.get('CameraModel'), old.get('Lens')])
+    return {
+        'tags': {t for t in old_tags if t and t != 'Unknown'},
+        'size': int(old.get('Size', 0)),
+        'processed_at': old.get('ProcessedAt'),
+        'grid_key': old.get('GridKey')
+    }
+
+def lost_race(e):
+    """True when a guarded write failed because another writer got there first."""
+    code = e.response.get('Error', {}).get('Code')
+    if code == 'ConditionalCheckFailedException': return True
+    reasons = e.response.get('CancellationReasons', [])
+    return code == 'TransactionCanceledException' and any(r.get('Code') == 'ConditionalCheckFailed' for r in reasons)
+
+# --- COUNTER COALESCING ---
+# TAG_CLOUD and PROFILE counters are hot items shared by every image, so images
+# only record their deltas and the batch flushes one ADD per distinct tag plus
+# one for the profile. Each delta is also written as a marker item
+# (USER#{id}#PENDING / IMAGE#{image_id}#{token}) in the same write that stores
+# the image row, and a flush deletes its markers in the transaction that applies
+# the counters, on condition they still exist. A flush that never happens
+# (timeout, OOM) or keeps conflicting on the hot items leaves its markers behind;
+# the user's next batch, the retry included, adopts the ones older than
+# `adopt_after` (at least the function timeout, so markers of running invocations
+# are left to them), and every delta is applied exactly once.
+TXN_MAX_ITEMS = 100
+TXN_RETRY_REASONS = {'TransactionConflict', 'ThrottlingError', 'ProvisionedThroughputExceeded'}
+
+def pending_marker(user_id, image_id, added=(), removed=(), size=0, images=0):
+    """Returns the marker item holding one image's counter delta, or None when there is nothing to count."""
+    tags = {tag: 0 for tag in set(added) | set(removed)}
+    for tag in added: tags[tag] += 1
+    for tag in removed: tags[tag] -= 1
+    tags = {tag: d for tag, d in tags.items() if d}
+    if not (tags or size or images): return None
+    return {
+        'PK': f"USER#{user_id}#PENDING", 'SK': f"IMAGE#{image_id}#{uuid.uuid4().hex}",
+        'Tags': tags, 'Size': size, 'Images': images, 'CreatedAt': datetime.now().isoformat()
+    }
+
+class CounterDeltas:
+    """Thread-safe set of one batch's unflushed markers (marker SK -> item)."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.markers = {}
+
+    def add(self, marker):
+        if not marker: return
+        with self.lock:
+            self.markers[marker['SK']] = marker
+
+    def drain(self):
+        """Returns the markers recorded so far and starts over from zero."""
+        with self.lock:
+            markers, self.markers = self.markers, {}
+        return markers
+
+    def adopt(self, user_id, table, older_than):
+        """Picks up markers older than `older_than` seconds, left by invocations that never flushed them; returns how many."""
+        cutoff = (datetime.now() - timedelta(seconds=older_than)).isoformat()
+        query = {
+            'KeyConditionExpression': "PK = :pk", 'FilterExpression': "CreatedAt < :cutoff",
+            'ExpressionAttributeValues': {':pk': f"USER#{user_id}#PENDING", ':cutoff': cutoff}
+        }
+        found = 0
+        while True:
+            resp = table.query(**query)
+            for item in resp.get('Items', []):
+                self.add(item)
+                found += 1
+            if 'LastEvaluatedKey' not in resp: return found
+            query['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+def counter_updates(markers, user_id, table_name):
+    """Returns TransactWriteItems actions (plain values, for the resource's client) for the summed non-zero deltas."""
+    tags, storage, images = {}, 0, 0
+    for marker in markers.values():
+        for tag, d in marker['Tags'].items():
+            tags[tag] = tags.get(tag, 0) + int(d)
+        storage += int(marker['Size'])
+        images += int(marker['Images'])
+    actions = [
+        {'Update': {
+            'TableName': table_name,
+            'Key': {'PK': f"USER#{user_id}#TAG_CLOUD", 'SK': f'TAG#{tag}'},
+            'UpdateExpression': "ADD #cnt :inc SET LabelName = :ln",
+            'ExpressionAttributeNames': {'#cnt': 'Count'},
+            'ExpressionAttributeValues': {':inc': delta, ':ln': tag}
+        }}
+        for tag, delta in sorted(tags.items()) if delta
+    ]
+    if storage or images:
+        actions.append({'Update': {
+            'TableName': table_name,
+            'Key': {'PK': f"USER#{user_id}#PROFILE", 'SK': 'METADATA'},
+            'UpdateExpression': "ADD StorageBytesUsed :sz, ImageCount :inc",
+            'ExpressionAttributeValues': {':sz': storage, ':inc': images}
+        }})
+    return actions
+
+def is_retryable(e):
+    """Throttles, plus transaction conflicts that succeed when simply sent again."""
+    if not isinstance(e, ClientError): return False
+    if is_throttle(e): return True
+    code = e.response.get('Error', {}).get('Code')
+    if code in ('TransactionConflictException', 'TransactionInProgressException'): return True
+    reasons = e.response.get('CancellationReasons', [])
+    return code == 'TransactionCanceledException' and any(r.get('Code') in TXN_RETRY_REASONS for r in reasons)
+
+def is_transient(e):
+    """Errors a later invocation may not hit again: retryable ones, AWS 5xx and connection failures."""
+    if is_retryable(e) or isinstance(e, (BotoCoreError, MemoryError)): return True
+    if not isinstance(e, ClientError): return False
+    status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+    return status >= 500 or e.response.get('Error', {}).get('Code') in ('InternalError', 'InternalServerError', 'ServiceUnavailable', 'RequestTimeout')
+
+def _flush_group(markers, user_id, table, settings):
+    """Applies one transaction's worth of markers and deletes them; returns the number of counter writes.
+
+    Markers still conflicting after `max_attempts` stay in the table for a later batch to adopt.
+    """
+    attempt = 0
+    while markers:
+        keys = sorted(markers)
+        counts = counter_updates(markers, user_id, table.name)
+        actions = [
+            {'Delete': {'TableName': table.name, 'Key': {'PK': markers[sk]['PK'], 'SK': sk}, 'ConditionExpression': "attribute_exists(PK)"}}
+            for sk in keys
+        ] + counts
+        # Same markers, same token: a retried call (ours or botocore's) is applied once
+        token = hashlib.sha256("".join(keys).encode()).hexdigest()[:36]
+        try:
+            table.meta.client.transact_write_items(TransactItems=actions, ClientRequestToken=token)
+            return len(counts)
+        except ClientError as e:
+            reasons = e.response.get('CancellationReasons', [])
+            # A marker already gone was flushed by another invocation that adopted it
+            gone = {keys[i] for i, r in enumerate(reasons[:len(keys)]) if r.get('Code') == 'ConditionalCheckFailed'}
+            if gone:
+                markers = {sk: m for sk, m in markers.items() if sk not in gone}
+                continue
+            attempt += 1
+            if not is_retryable(e): raise
+            if attempt == settings['max_attempts']:
+                print(f"⚠️ [COUNTERS] {len(markers)} image delta(s) left pending after {attempt} conflicting attempts: {e}")
+                return 0
+            time.sleep(random.uniform(0, min(settings['backoff_cap'], settings['backoff_base'] * 2 ** attempt)))
+    return 0
+
+def _groups(markers):
+    """Splits markers into transactions of at most TXN_MAX_ITEMS items."""
+    groups, group, tags = [], {}, set()
+    for sk, marker in sorted(markers.items()):
+        merged = tags | set(marker['Tags'])
+        # One delete per marker, one update per tag, one for the profile
+        if group and len(group) + 1 + len(merged) + 1 > TXN_MAX_ITEMS:
+            groups.append(group)
+            group, merged = {}, set(marker['Tags'])
+        group[sk], tags = marker, merged
+    if group: groups.append(group)
+    return groups
+
+def flush_counters(markers, user_id, table, settings):
+    """Applies drained markers in parallel transactions; returns the number of counter writes."""
+    if not markers: return 0
+    groups = _groups(markers)
+    with ThreadPoolExecutor(max_workers=min(settings['concurrency'], len(groups))) as pool:
+        writes = sum(pool.map(lambda g: _flush_group(g, user_id, table, settings), groups))
+    if settings.get('debug'): print(f"🧮 [COUNTERS] {len(markers)} image delta(s), {writes} counter writes in {len(groups)} transaction(s)")
+    return writes
 
 # --- PRESERVED UTILITIES ---
 def parse_exif_numeric(val):
@@ -78,14 +400,6 @@ def parse_gps(val, ref):
     except:
         return None
 
-def get_fuzzy_tag(data, pattern):
-    matches = [
-        (k, str(v).strip()) for k, v in data.items()
-        if re.search(pattern, k, re.I) and v is not None and str(v).strip() != ""
-    ]
-    if not matches: return None
-    return sorted(matches, key=lambda x: len(x[0]))[0][1]
-
 def wrap_decimal(obj):
     if isinstance(obj, list): return [wrap_decimal(i) for i in obj]
     if isinstance(obj, dict): return {k: wrap_decimal(v) for k, v in obj.items()}
@@ -95,44 +409,243 @@ def wrap_decimal(obj):
 def generate_short_id(s3_key):
     return hashlib.sha256(s3_key.encode()).hexdigest()[:12]
 
-# --- MAIN PROCESSOR ---
-def process_image(img_data, user_id, settings, s3, rek, table):
-    filename = img_data['filename']
-    raw_exif = json.loads(brotli.decompress(base64.b64decode(img_data['exif'])))
-    preview_bytes = brotli.decompress(base64.b64decode(img_data['thumb']))
-    file_size = len(preview_bytes)
+# --- EXISTENCE PRE-CHECK ---
+# Image ids only need the capture date and the filename, so each window of the
+# payload is checked with BatchGetItem before any thumbnail is decompressed. The
+# conditional image put in process_image still settles races with other batches.
+BATCH_GET_MAX = 100
 
-    exif_date_raw = get_fuzzy_tag(raw_exif, r'SubSecCreateDate|SubSecDateTimeOriginal|CreateDate|DateTimeOriginal|CreateDate$')
-    image_id = hashlib.sha256(f"{exif_date_raw}{filename}".encode()).hexdigest()[:10]
+def image_id_for(exif_date, filename):
+    return hashlib.sha256(f"{exif_date}{filename}".encode()).hexdigest()[:10]
 
-    pk = f"USER#{user_id}#IMAGE"
-    sk = f"IMAGE#{image_id}"
+def prepare_image(img_data):
+    """Decodes only the EXIF field and derives the image id; the thumbnail stays compressed."""
+    img_data['raw_exif'] = json.loads(decode_field(img_data, 'exif'))
+    img_data['fields'] = exif_fields.resolve(img_data['raw_exif'])
+    img_data['image_id'] = image_id_for(img_data['fields']['date'], img_data['filename'])
 
-    if settings.get('force_reprocess', False):
-        if img_data.get('force_reprocess', False) or settings.get('force_reprocess', False):
-            if settings.get('debug'): print(f"♻️ [FORCE] Correcting stats/tags for {image_id}")
-            undo_old_metrics(user_id, image_id, table, settings)
-    else:
-        existing = table.get_item(Key={'PK': pk, 'SK': sk}, ProjectionExpression="PK")
-        if 'Item' in existing: return
+def is_forced(img_data, settings):
+    return img_data.get('force_reprocess', False) or settings.get('force_reprocess', False)
 
-    iso_date_str = re.sub(r'^(\d{4}):(\d{2}):(\d{2})', r'\1-\2-\3', str(exif_date_raw)).replace(" ", "T")
-    dt_obj = datetime.fromisoformat(iso_date_str)
-    dt_str = dt_obj.isoformat()
-    date_path = dt_obj.strftime('%Y/%m/%d')
-    s3_key = f"protected/{user_id}/{date_path}/{filename}.jpg"
+def _batch_get(keys, table, settings):
+    found = set()
+    request = {table.name: {'Keys': keys, 'ProjectionExpression': 'SK'}}
+    for attempt in range(settings['max_attempts'] * 2):
+        resp = table.meta.client.batch_get_item(RequestItems=request)
+        found.update(item['SK'] for item in resp['Responses'].get(table.name, []))
+        request = resp.get('UnprocessedKeys')
+        if not request: return found
+        time.sleep(random.uniform(0, min(settings['backoff_cap'], settings['backoff_base'] * 2 ** attempt)))
+    raise RuntimeError(f"BatchGetItem left {len(request[table.name]['Keys'])} keys unprocessed")
 
-    s3.put_object(Bucket=settings['assets_bucket'], Key=s3_key, Body=preview_bytes, ContentType='image/jpeg')
+def existing_image_ids(image_ids, user_id, table, settings):
+    """Returns the subset of `image_ids` already stored for the user."""
+    keys = [{'PK': f"USER#{user_id}#IMAGE", 'SK': f"IMAGE#{i}"} for i in sorted(image_ids)]
+    if not keys: return set()
+    chunks = [keys[i:i + BATCH_GET_MAX] for i in range(0, len(keys), BATCH_GET_MAX)]
+    with ThreadPoolExecutor(max_workers=min(settings['concurrency'], len(chunks))) as pool:
+        found = set().union(*pool.map(lambda c: _batch_get(c, table, settings), chunks))
+    return {sk.split('#', 1)[1] for sk in found}
 
-    img = Image.open(io.BytesIO(preview_bytes))
-    img.thumbnail((1600, 1600))
-    rek_buf = io.BytesIO()
-    img.save(rek_buf, format="JPEG", quality=85)
-    rek_payload = rek_buf.getvalue()
+# --- EXIF SIDECAR ---
+# The filtered exiftool map is only needed by GET /image/{id}/exif, so it lives in
+# its own compressed item instead of the image item (and so out of ImageIdIndex).
+# Reads and writes of the image row stay small; the sidecar is written with it.
+EXIF_CODEC = 'zlib'
+
+def exif_sidecar(user_id, image_id, exif):
+    """Returns the sidecar item holding `exif` as compressed JSON."""
+    body = json.dumps(exif, default=str, separators=(',', ':')).encode()
+    return {
+        'PK': f"USER#{user_id}#EXIF", 'SK': f"IMAGE#{image_id}",
+        'Codec': EXIF_CODEC, 'Exif': zlib.compress(body, 9), 'ExifBytes': len(body)
+    }
+
+# --- BATCH PROGRESS ---
+# Every batch blob gets a progress record (USER#{id}#BATCH / BATCH#{key}) and
+# its images are numbered in payload order. Finished ordinals are checkpointed
+# together with the counters they produced, so a retried invocation skips them
+# before decoding anything. Failed images get one item each under the record.
+# An image still failing on its `dead_letter_after`-th invocation, or failing
+# with a permanent error (no capture date, a corrupt preview) on any, is written
+# under failed/ as a one-image JSON batch (copy it back to incoming/ to replay)
+# and stops holding the blob back. A re-uploaded blob has a new ETag and starts over.
+# A blob deleted with images set aside leaves `<blob>.dead` naming them, so
+# `bulk.py --confirm` does not mark those files confirmed (it deletes the marker
+# once recorded).
+DEAD_LETTER_PREFIX = "failed/"
+DEAD_MARKER_SUFFIX = ".dead"
+
+class BatchProgress:
+    """Thread-safe record of which images of one batch blob are done, failed or dead-lettered."""
+    def __init__(self, table, user_id, bucket, source, etag, settings):
+        self.table = table
+        self.user_id, self.bucket, self.source, self.etag = user_id, bucket, source, etag
+        self.settings = settings
+        self.key = {'PK': f"USER#{user_id}#BATCH", 'SK': f"BATCH#{source}"}
+        self.lock = threading.Lock()
+        self.done, self.dead, self.attempts = set(), set(), {}
+        self.dead_files = {}
+        self.new_done, self.new_dead, self.new_failures = set(), set(), {}
+        self.total = None
+
+    def _ttl(self):
+        return int(time.time() + self.settings['progress_ttl_days'] * 86400)
+
+    def load(self):
+        """Reads what earlier invocations finished, or starts a fresh record."""
+        sk, record, items = self.key['SK'], None, []
+        query = {
+            'KeyConditionExpression': "PK = :pk AND begins_with(SK, :sk)",
+            'ExpressionAttributeValues': {':pk': self.key['PK'], ':sk': sk},
+            'ConsistentRead': True
+        }
+        while True:
+            resp = self.table.query(**query)
+            items.extend(resp.get('Items', []))
+            if 'LastEvaluatedKey' not in resp: break
+            query['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+        for item in items:
+            # Items left by an earlier upload under the same key are ignored
+            if item.get('ETag') != self.etag: continue
+            if item['SK'] == sk:
+                record = item
+            elif item['SK'].startswith(f"{sk}#IMAGE#"):
+                self.attempts[int(item['Ordinal'])] = int(item['Attempts'])
+                if item.get('DeadLetterKey'): self.dead_files[int(item['Ordinal'])] = item.get('Filename')
+        if record is None:
+            self.attempts, self.dead_files = {}, {}
+            self.table.put_item(Item={
+                **self.key, 'Source': self.source, 'ETag': self.etag, 'Status': 'IN_PROGRESS',
+                'StartedAt': datetime.now().isoformat(), 'TimeToLive': self._ttl()
+            })
+        else:
+            self.done = {int(o) for o in record.get('Done', ())}
+            self.dead = {int(o) for o in record.get('DeadLettered', ())}
+        return self
 
+    def settled(self, ordinal):
+        return ordinal in self.done or ordinal in self.dead
+
+    def attempt(self, ordinal):
+        """Returns which invocation this is for the image, counting the ones it failed in."""
+        return self.attempts.get(ordinal, 0) + 1
+
+    def succeeded(self, ordinal):
+        with self.lock:
+            self.done.add(ordinal)
+            self.new_done.add(ordinal)
+
+    def failed(self, ordinal, filename, error, attempt, dead_letter_key=None):
+        with self.lock:
+            self.new_failures[ordinal] = {
+                'Filename': filename, 'Error': str(error)[:1000], 'Attempts': attempt,
+                'FailedAt': datetime.now().isoformat(), 'DeadLetterKey': dead_letter_key
+            }
+            if dead_letter_key:
+                self.dead.add(ordinal)
+                self.new_dead.add(ordinal)
+                self.dead_files[ordinal] = filename
+
+    def pending(self):
+        """Number of settled images not yet checkpointed."""
+        with self.lock:
+            return len(self.new_done) + len(self.new_failures)
+
+    def drain(self):
+        with self.lock:
+            drained = (self.new_done, self.new_dead, self.new_failures)
+            self.new_done, self.new_dead, self.new_failures = set(), set(), {}
+        return drained
+
+    def commit(self, drained, status='IN_PROGRESS'):
+        """Writes drained results: failure items first, then the record's sets and status."""
+        done, dead, failures = drained
+        ttl = self._ttl()
+        if failures:
+            with self.table.batch_writer() as batch:
+                for ordinal, failure in failures.items():
+                    batch.put_item(Item={
+                        'PK': self.key['PK'], 'SK': f"{self.key['SK']}#IMAGE#{ordinal:06d}",
+                        'Ordinal': ordinal, 'ETag': self.etag, 'TimeToLive': ttl,
+                        **{k: v for k, v in failure.items() if v is not None}
+                    })
+        expr = "SET #st = :st, UpdatedAt = :now, TimeToLive = :ttl"
+        names = {'#st': 'Status'}
+        values = {':st': status, ':now': datetime.now().isoformat(), ':ttl': ttl, ':etag': self.etag}
+        if self.total is not None:
+            expr += ", #total = :total"
+            names['#total'] = 'Total'
+            values[':total'] = self.total
+        adds = []
+        if done:
+            adds.append("Done :done")
+            values[':done'] = done
+        if dead:
+            adds.append("DeadLettered :dead")
+            values[':dead'] = dead
+        if adds: expr += " ADD " + ", ".join(adds)
+        # A re-upload under the same key owns the record from then on
+        self.table.update_item(
+            Key=self.key, UpdateExpression=expr, ConditionExpression="ETag = :etag",
+            ExpressionAttributeNames=names, ExpressionAttributeValues=values
+        )
+
+def checkpoint(progress, counters, user_id, table, settings, status='IN_PROGRESS'):
+    """Commits finished images: their counter deltas first, then their ordinals."""
+    # Drained first: every image drained here has already recorded its counters
+    drained = progress.drain()
+    with carnus_metrics.stage('Counters'):
+        flush_counters(counters.drain(), user_id, table, settings)
+    with carnus_metrics.stage('Checkpoint'):
+        progress.commit(drained, status)
+
+def _portable_field(img_data, name):
+    """Returns a field in legacy JSON form (base64 of brotli), re-encoding container fields when needed."""
+    value = img_data[name]
+    if isinstance(value, str): return value
+    if img_data['decoders'][name] is FIELD_CODECS['br']: return base64.b64encode(value).decode()
+    return base64.b64encode(brotli.compress(decode_field(img_data, name), quality=5)).decode()
+
+def dead_letter(img_data, error, ordinal, attempt, progress, s3):
+    """Writes the image as a one-image JSON batch under failed/ and returns its key."""
+    filename = img_data.get('filename')
+    key = f"{DEAD_LETTER_PREFIX}{progress.user_id}/{os.path.basename(progress.source)}/{ordinal:06d}-{os.path.basename(str(filename))}.json"
+    image = {'filename': filename, 'force_reprocess': img_data.get('force_reprocess', False)}
+    for name in ('exif', 'thumb'):
+        if name not in img_data: continue
+        try:
+            image[name] = _portable_field(img_data, name)
+        except Exception:
+            # Undecodable fields are kept as stored so nothing is lost
+            image[f"{name}_stored"] = base64.b64encode(img_data[name]).decode()
+    body = {
+        'user_id': progress.user_id, 'source': progress.source, 'ordinal': ordinal,
+        'attempts': attempt, 'error': str(error), 'images': [image]
+    }
+    s3.put_object(Bucket=progress.bucket, Key=key, Body=json.dumps(body).encode(), ContentType='application/json')
+    return key
+
+def write_dead_marker(s3, bucket, key, dead=None):
+    """Leaves `<key>.dead` listing the images ({ordinal: filename}) set aside from a blob about to be deleted (None = all of them)."""
+    ordinals = None if dead is None else sorted(dead)
+    names = None if dead is None else sorted({os.path.basename(str(f)) for f in dead.values() if f})
+    body = {'source': key, 'ordinals': ordinals, 'filenames': names, 'at': datetime.now().isoformat()}
+    s3.put_object(Bucket=bucket, Key=key + DEAD_MARKER_SUFFIX, Body=json.dumps(body).encode(), ContentType='application/json')
+
+# --- LABEL CACHE ---
+# Rekognition results keyed by a hash of the exact bytes sent to it, shared by
+# every user since identical bytes label identically. Re-labeling runs and
+# re-exports of the same frame skip both detect_labels and detect_faces. Entries
+# carry the table's TimeToLive so DynamoDB expires them; REK_CACHE_VERSION
+# changes whenever the request parameters or the stored shape do.
+REK_CACHE_VERSION = "v1-max15-conf75"
+
+def detect_labels_and_faces(rek_payload, rek):
+    """Calls Rekognition; returns (labels, faces) as stored on the image item."""
     rek_resp = rek.detect_labels(Image={'Bytes': rek_payload}, MaxLabels=15, MinConfidence=75)
     labels = [l['Name'] for l in rek_resp['Labels']] or ["Uncategorized"]
-
+    
     faces = []
     if any(l['Name'] == 'Face' and l['Confidence'] > 75 for l in rek_resp['Labels']):
         face_resp = rek.detect_faces(Image={'Bytes': rek_payload}, Attributes=['ALL'])
@@ -149,92 +662,473 @@ def process_image(img_data, user_id, settings, s3, rek, table):
                     for e in face.get("Emotions", []) if e.get("Confidence", 0) >= 60
                 ]
             })
+    return labels, faces
+
+class LabelCache:
+    """DynamoDB-backed Rekognition cache with hit/miss counts for one invocation."""
+    def __init__(self, table, ttl_days=30, enabled=True):
+        self.table = table
+        self.ttl = int(ttl_days * 86400)
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _count(self, hit):
+        with self.lock:
+            if hit: self.hits += 1
+            else: self.misses += 1
+
+    def lookup(self, rek_payload, rek):
+        if not self.enabled:
+            return detect_labels_and_faces(rek_payload, rek)
+        key = {'PK': f"REKCACHE#{hashlib.sha256(rek_payload).hexdigest()}", 'SK': REK_CACHE_VERSION}
+        try:
+            item = self.table.get_item(Key=key).get('Item')
+        except ClientError as e:
+            if is_throttle(e): raise
+            print(f"⚠️ [CACHE] Read failed: {e}")
+            item = None
+        # TTL deletion is lazy, so expired entries can still be returned
+        if item and int(item.get('TimeToLive', 0)) > time.time():
+            self._count(True)
+            return list(item['Labels']), list(item.get('Faces', []))
+
+        self._count(False)
+        labels, faces = detect_labels_and_faces(rek_payload, rek)
+        try:
+            self.table.put_item(Item=wrap_decimal({
+                **key, 'Labels': labels, 'Faces': faces,
+                'CachedAt': datetime.now().isoformat(), 'TimeToLive': int(time.time()) + self.ttl
+            }))
+        except ClientError as e:
+            print(f"⚠️ [CACHE] Write failed: {e}")
+        return labels, faces
+
+# --- IMAGE PREPARATION ---
+# Each preview is decoded at most once, and JPEGs decode straight to a reduced
+# DCT scale (draft mode) when the largest rendition needed is at most half the
+# preview. Previews Rekognition accepts as-is are sent as the original bytes;
+# otherwise the pixels are resized to REK_PX and encoded once. Those same pixels
+# then yield every derivative: a grid tile for gallery pages, a detail size for
+# the modal, and the preview itself ("full", still ThumbnailKey). Renditions sit
+# next to it as {name}.{grid|detail}.{ext}.
+REK_PX = 1600
+REK_QUALITY = 85
+REK_MAX_BYTES = 5 * 1024 * 1024
+REK_MIN_PX = 80
+REK_FORMATS = ('JPEG', 'PNG')
+DERIVATIVE_TYPES = {'jpeg': ('jpg', 'image/jpeg'), 'webp': ('webp', 'image/webp')}
+
+def encode(img, fmt, quality):
+    buf = io.BytesIO()
+    img.save(buf, format=fmt.upper(), quality=quality)
+    return buf.getvalue()
+
+def prepare_renditions(preview_bytes, settings):
+    """Returns (rek_payload, {'detail': bytes, 'grid': bytes}) from a single decode."""
+    img = Image.open(io.BytesIO(preview_bytes))
+    passthrough = (
+        img.format in REK_FORMATS and len(preview_bytes) <= REK_MAX_BYTES
+        and REK_MIN_PX <= min(img.size) and max(img.size) <= settings['rek_max_px']
+    )
+    original_size = img.size
+    largest = settings['detail_px'] if passthrough else max(settings['detail_px'], REK_PX)
+    img.draft('RGB', (largest, largest))
+    if img.mode not in ('RGB', 'L'): img = img.convert('RGB')
+
+    # JPEG bytes already holding these exact pixels: size -> (bytes, quality or None for the original)
+    encoded = {}
+    if passthrough:
+        rek_payload = preview_bytes
+        if img.format == 'JPEG' and img.size == original_size:
+            encoded[img.size] = (preview_bytes, None)
+    else:
+        img.thumbnail((REK_PX, REK_PX))
+        rek_payload = encode(img, 'jpeg', REK_QUALITY)
+        encoded[img.size] = (rek_payload, REK_QUALITY)
+
+    fmt, quality = settings['derivative_format'], settings['derivative_quality']
+    renditions = {}
+    for name in ('detail', 'grid'):
+        px = settings[f'{name}_px']
+        img.thumbnail((px, px))
+        body, q = encoded.get(img.size, (None, None))
+        if fmt != 'jpeg' or body is None or q not in (None, quality):
+            body = encode(img, fmt, quality)
+        renditions[name] = body
+    return rek_payload, renditions
+
+def store_derivatives(renditions, full_key, s3, settings):
+    """Uploads the renditions next to the full preview; returns their keys."""
+    ext, content_type = DERIVATIVE_TYPES[settings['derivative_format']]
+    base = full_key.rsplit('.', 1)[0]
+    keys = {}
+    for name, body in renditions.items():
+        keys[name] = f"{base}.{name}.{ext}"
+        s3.put_object(Bucket=settings['assets_bucket'], Key=keys[name], Body=body, ContentType=content_type)
+    return keys
+
+# --- CONCURRENCY ---
+# Images in a batch are independent, so they run on a thread pool that shares one
+# set of clients. botocore's adaptive retry mode rate-limits each client when
+# Rekognition or DynamoDB throttle; whatever still escapes halves the number of
+# images in flight (AIMD) and the image is retried after a jittered backoff.
+THROTTLE_CODES = {
+    'ThrottlingException', 'ProvisionedThroughputExceededException', 'RequestLimitExceeded',
+    'LimitExceededException', 'TooManyRequestsException', 'SlowDown'
+}
+
+def is_throttle(e):
+    return isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in THROTTLE_CODES
+
+class AdaptiveLimiter:
+    """Caps images in flight; halves on throttling, grows by one per `limit` successes."""
+    def __init__(self, limit, minimum=1):
+        self.ceiling = max(1, limit)
+        self.minimum = max(1, min(minimum, self.ceiling))
+        self.limit = self.ceiling
+        self.active = 0
+        self.successes = 0
+        self.cond = threading.Condition()
+
+    def __enter__(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def throttled(self):
+        with self.cond:
+            self.limit = max(self.minimum, self.limit // 2)
+            self.successes = 0
 
-    lens_val = get_fuzzy_tag(raw_exif, r'LensID$|LensModel$|^Lens$')
-    camera_model = get_fuzzy_tag(raw_exif, r'Model$|UniqueCameraModel$')
-    make_val = get_fuzzy_tag(raw_exif, r'Make$|Manufacturer$')
+    def succeeded(self):
+        with self.cond:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.ceiling:
+                self.limit += 1
+                self.successes = 0
+                self.cond.notify()
+
+def process_batch(images, user_id, settings, s3, rek, table, counters, progress):
+    """Processes new (or forced) images as they stream in; returns [(filename, error)] for the ones left to retry.
+
+    Images already settled in `progress` are skipped undecoded. The rest are
+    pulled `window` at a time, prepared and existence-checked together, and
+    queued behind a semaphore that frees as workers finish, so at most about
+    two windows of images are held at once. Progress is checkpointed every
+    `checkpoint_every` settled images.
+    """
+    failed = []
+    failed_lock = threading.Lock()
+    slots = threading.Semaphore(settings['window'])
+    limiter = AdaptiveLimiter(settings['concurrency'], settings['min_concurrency'])
+
+    def run(img):
+        for attempt in range(1, settings['max_attempts'] + 1):
+            with limiter:
+                try:
+                    process_image(img, user_id, settings, s3, rek, table, counters)
+                    limiter.succeeded()
+                    return None
+                except Exception as e:
+                    if not is_retryable(e) or attempt == settings['max_attempts']:
+                        print(f"❌ [IMAGE] {img.get('filename')}: {e}")
+                        return e
+                    limiter.throttled()
+            if settings.get('debug'): print(f"🐢 [THROTTLE] {img.get('filename')} retry {attempt} at concurrency {limiter.limit}")
+            time.sleep(random.uniform(0, min(settings['backoff_cap'], settings['backoff_base'] * 2 ** attempt)))
+
+    def record_failure(ordinal, img, err):
+        attempt = progress.attempt(ordinal)
+        dead_key = None
+        # Replaying the blob cannot fix a permanent error, so only transient ones use up attempts
+        permanent = not is_transient(err)
+        if permanent or attempt >= settings['dead_letter_after']:
+            try:
+                dead_key = dead_letter(img, err, ordinal, attempt, progress, s3)
+                reason = f"permanent {type(err).__name__}" if permanent else f"{attempt} attempts"
+                print(f"🪦 [DEAD LETTER] {img.get('filename')} after {reason}: {dead_key}")
+            except Exception as e:
+                print(f"❌ [DEAD LETTER] {img.get('filename')}: {e}")
+        progress.failed(ordinal, img.get('filename'), err, attempt, dead_key)
+        if dead_key is None:
+            with failed_lock: failed.append((img.get('filename'), err))
+
+    def run_slot(ordinal, img):
+        # Nothing may escape here: the futures are never read, so an exception would drop the image silently
+        try:
+            err = run(img)
+        except Exception as e:
+            err = e
+        finally:
+            slots.release()
+        if err:
+            record_failure(ordinal, img, err)
+        else:
+            progress.succeeded(ordinal)
+            carnus_metrics.add('ImagesProcessed')
+
+    seen = skipped = resumed = 0
+    with ThreadPoolExecutor(max_workers=settings['concurrency']) as pool:
+        images = enumerate(images)
+        while window := list(itertools.islice(images, settings['window'])):
+            seen += len(window)
+            prepared = []
+            for ordinal, img in window:
+                if progress.settled(ordinal):
+                    resumed += 1
+                    continue
+                try:
+                    with carnus_metrics.stage('ExifParse'):
+                        prepare_image(img)
+                    prepared.append((ordinal, img))
+                except Exception as e:
+                    print(f"❌ [IMAGE] {img.get('filename')}: {e}")
+                    record_failure(ordinal, img, e)
+
+            with carnus_metrics.stage('ExistenceCheck'):
+                existing = existing_image_ids({img['image_id'] for _, img in prepared if not is_forced(img, settings)}, user_id, table, settings)
+            for ordinal, img in prepared:
+                if is_forced(img, settings) or img['image_id'] not in existing:
+                    slots.acquire()
+                    pool.submit(run_slot, ordinal, img)
+                else:
+                    skipped += 1
+                    progress.succeeded(ordinal)
+            if progress.pending() >= settings['checkpoint_every']:
+                checkpoint(progress, counters, user_id, table, settings)
+    progress.total = seen
+    carnus_metrics.add('Images', seen)
+    carnus_metrics.add('ImagesResumed', resumed)
+    carnus_metrics.add('ImagesSkipped', skipped)
+    carnus_metrics.add('ImagesFailed', len(failed))
+    if settings.get('debug'): print(f"⏭️ [SKIP] {resumed}/{seen} images settled earlier, {skipped} already stored")
+    return failed
+
+# --- MAIN PROCESSOR ---
+def process_image(img_data, user_id, settings, s3, rek, table, counters):
+    # prepare_image ran during the batch's existence pre-check
+    filename = img_data['filename']
+    raw_exif = img_data['raw_exif']
+    fields = img_data['fields']
+    image_id = img_data['image_id']
+    force = is_forced(img_data, settings)
+    with carnus_metrics.stage('Decompress'):
+        preview_bytes = decode_field(img_data, 'thumb')
+    file_size = len(preview_bytes)
+
+    exif_date_raw = fields['date']
+    pk = f"USER#{user_id}#IMAGE"
+    sk = f"IMAGE#{image_id}"
+
+    iso_date_str = re.sub(r'^(\d{4}):(\d{2}):(\d{2})', r'\1-\2-\3', str(exif_date_raw)).replace(" ", "T")
+    dt_obj = datetime.fromisoformat(iso_date_str)
+    dt_str = dt_obj.isoformat()
+    date_path = dt_obj.strftime('%Y/%m/%d')
+    s3_key = f"protected/{user_id}/{date_path}/{filename}.jpg"
+
+    with carnus_metrics.stage('S3Put'):
+        s3.put_object(Bucket=settings['assets_bucket'], Key=s3_key, Body=preview_bytes, ContentType='image/jpeg')
+
+    with carnus_metrics.stage('Resize'):
+        rek_payload, renditions = prepare_renditions(preview_bytes, settings)
+    with carnus_metrics.stage('Rekognition'):
+        labels, faces = settings['label_cache'].lookup(rek_payload, rek)
+    with carnus_metrics.stage('S3Put'):
+        derivative_keys = store_derivatives(renditions, s3_key, s3, settings)
+
+    lens_val = fields['lens']
+    camera_model = fields['model']
+    make_val = fields['make']
 
     hw_tags = [v for v in [make_val, camera_model, lens_val] if v and v != 'Unknown']
     all_searchable_tags = set(labels + hw_tags)
 
-    gps_lat = parse_gps(get_fuzzy_tag(raw_exif, r'GPSLatitude$'), get_fuzzy_tag(raw_exif, r'GPSLatitudeRef$'))
-    gps_lon = parse_gps(get_fuzzy_tag(raw_exif, r'GPSLongitude$'), get_fuzzy_tag(raw_exif, r'GPSLongitudeRef$'))
+    gps_lat = parse_gps(fields['gps_lat'], fields['gps_lat_ref'])
+    gps_lon = parse_gps(fields['gps_lon'], fields['gps_lon_ref'])
 
     item_data = {
         'PK': pk, 'SK': sk, 'UserId': user_id, 'ImageId': image_id, 'ImageName': filename,
         'CaptureDate': dt_str, 'ProcessedAt': datetime.now().isoformat(),
         'Labels': labels, 'Faces': faces, 'ThumbnailKey': s3_key, 'Size': file_size,
+        'GridKey': derivative_keys['grid'], 'DetailKey': derivative_keys['detail'],
         'Lens': lens_val or 'Unknown', 'CameraModel': camera_model or 'Unknown', 'Make': make_val or 'Unknown',
         'GPSLatitude': gps_lat, 'GPSLongitude': gps_lon,
-        'ISO': parse_exif_numeric(get_fuzzy_tag(raw_exif, r'ISO$')),
-        'Aperture': parse_exif_numeric(get_fuzzy_tag(raw_exif, r'FNumber$|Aperture$')),
-        'ShutterSpeed': get_fuzzy_tag(raw_exif, r'ExposureTime$|ShutterSpeed$'),
-        'exif': {}
+        'ISO': parse_exif_numeric(fields['iso']),
+        'Aperture': parse_exif_numeric(fields['aperture']),
+        'ShutterSpeed': fields['shutter']
     }
+    sidecar = exif_sidecar(user_id, image_id, exif_fields.storable(raw_exif))
 
-    omit = [r'MakerNote', r'Image', r'Profile', r'Curve', r'Matrix', r'Data', r'Table']
-    for key, value in raw_exif.items():
-        if any(re.search(p, key, re.I) for p in omit): continue
-        if isinstance(value, (bytes, bytearray)) or "(Binary data" in str(value): continue
-        safe_key = re.sub(r'[^a-zA-Z0-9_]', '_', key).strip('_')
-        item_data['exif'][safe_key] = value
+    tags = {t for t in all_searchable_tags if t}
+    # Tag rows sort by capture time (see carnus_keys)
+    tag_sk = carnus_keys.tag_sort_key(dt_str, image_id)
+    def tag_row(tag):
+        return wrap_decimal({
+            'PK': f"USER#{user_id}#TAG#{tag}", 'SK': tag_sk,
+            'GSI1PK': f"TAG#{tag}", 'GSI1SK': tag_sk,
+            'ImageName': filename, 'ImageId': image_id, 'Timestamp': dt_str, 'ThumbnailKey': s3_key,
+            'GridKey': derivative_keys['grid']
+        })
+
+    # Read only once Rekognition has answered, so a throttled attempt can be retried
+    previous = None
+    if force:
+        with carnus_metrics.stage('DynamoDBRead'):
+            previous = previous_metrics(user_id, image_id, table)
+
+    # The counter delta is written with the image row as a marker; the batch flushes it
+    with carnus_metrics.stage('DynamoDBWrite'):
+        try:
+            if previous is None:
+                with table.batch_writer() as batch:
+                    batch.put_item(Item=sidecar)
+                    for tag in tags:
+                        batch.put_item(Item=tag_row(tag))
+                marker = pending_marker(user_id, image_id, added=tags, size=file_size, images=1)
+                # The image row commits the ingest; if another writer got there first it wins
+                table.meta.client.transact_write_items(TransactItems=[
+                    {'Put': {'TableName': table.name, 'Item': wrap_decimal(item_data), 'ConditionExpression': "attribute_not_exists(PK)"}},
+                    {'Put': {'TableName': table.name, 'Item': marker}}
+                ])
+                counters.add(marker)
+            else:
+                added, removed = tags - previous['tags'], previous['tags'] - tags
+                # Unchanged tag rows are identical unless the grid rendition moved (format change, backfill)
+                rewrite = tags if previous['grid_key'] != derivative_keys['grid'] else added
+                if settings.get('debug'): print(f"♻️ [FORCE] {image_id}: +{len(added)} / -{len(removed)} tags")
+                guard = {'ConditionExpression': "attribute_not_exists(ProcessedAt)"}
+                if previous['processed_at'] is not None:
+                    guard = {'ConditionExpression': "ProcessedAt = :prev", 'ExpressionAttributeValues': {':prev': previous['processed_at']}}
+                actions = [{'Put': {'TableName': table.name, 'Item': wrap_decimal(item_data), **guard}}]
+                actions.append({'Put': {'TableName': table.name, 'Item': sidecar}})
+                actions += [{'Put': {'TableName': table.name, 'Item': tag_row(t)}} for t in rewrite]
+                # Tag rows may still use the legacy key if the migration has not run yet: a rewritten
+                # tag drops it (or galleries would list the image twice), a removed tag drops both
+                legacy_sk = carnus_keys.legacy_sort_key(image_id)
+                actions += [
+                    {'Delete': {'TableName': table.name, 'Key': {'PK': f"USER#{user_id}#TAG#{t}", 'SK': key}}}
+                    for t, key in [(t, legacy_sk) for t in rewrite] + [(t, k) for t in removed for k in (tag_sk, legacy_sk)]
+                ]
+                marker = pending_marker(user_id, image_id, added=added, removed=removed, size=file_size - previous['size'])
+                if marker: actions.append({'Put': {'TableName': table.name, 'Item': marker}})
+                table.meta.client.transact_write_items(TransactItems=actions)
+                counters.add(marker)
+        except ClientError as e:
+            # Anything but a lost race fails the image, so it is retried rather than checkpointed
+            if not lost_race(e): raise
+            if settings.get('debug'): print(f"⏭️ [SKIP] {image_id} was written concurrently")
 
-    try:
-        with table.batch_writer() as batch:
-            batch.put_item(Item=wrap_decimal(item_data))
-            for tag in {t for t in all_searchable_tags if t}:
-                batch.put_item(Item=wrap_decimal({
-                    'PK': f"USER#{user_id}#TAG#{tag}", 'SK': sk,
-                    'GSI1PK': f"TAG#{tag}", 'GSI1SK': sk,
-                    'ImageName': filename, 'ImageId': image_id, 'Timestamp': dt_str, 'ThumbnailKey': s3_key
-                }))
-
-        for tag in {t for t in all_searchable_tags if t}:
-            table.update_item(
-                Key={'PK': f"USER#{user_id}#TAG_CLOUD", 'SK': f'TAG#{tag}'},
-                UpdateExpression="ADD #cnt :inc SET LabelName = :ln",
-                ExpressionAttributeNames={'#cnt': 'Count'},
-                ExpressionAttributeValues={':inc': 1, ':ln': tag}
-            )
-
-        table.update_item(
-            Key={'PK': f"USER#{user_id}#PROFILE", 'SK': 'METADATA'},
-            UpdateExpression="ADD StorageBytesUsed :sz, ImageCount :inc",
-            ExpressionAttributeValues={':sz': file_size, ':inc': 1}
-        )
-    except Exception as e:
-        print(f"❌ DynamoDB Error: {e}")
 
 def lambda_handler(event, context):
-    s3 = boto3.client('s3')
-    rek = boto3.client('rekognition')
-    table = boto3.resource('dynamodb').Table(os.environ['TABLE_NAME'])
     settings = {
         'assets_bucket': os.environ['THUMB_BUCKET'],
-        'debug': os.environ.get('DEBUG', 'false').lower() == 'true'
+        'debug': os.environ.get('DEBUG', 'false').lower() == 'true',
+        'concurrency': int(os.environ.get('IMAGE_CONCURRENCY', 8)),
+        'min_concurrency': int(os.environ.get('IMAGE_CONCURRENCY_MIN', 1)),
+        'max_attempts': int(os.environ.get('IMAGE_MAX_ATTEMPTS', 4)),
+        'backoff_base': float(os.environ.get('IMAGE_BACKOFF_BASE', 0.5)),
+        'backoff_cap': float(os.environ.get('IMAGE_BACKOFF_CAP', 8)),
+        'derivative_format': os.environ.get('DERIVATIVE_FORMAT', 'jpeg').lower(),
+        'derivative_quality': int(os.environ.get('DERIVATIVE_QUALITY', REK_QUALITY)),
+        'grid_px': int(os.environ.get('DERIVATIVE_GRID_PX', 400)),
+        'detail_px': int(os.environ.get('DERIVATIVE_DETAIL_PX', 1600)),
+        'rek_max_px': int(os.environ.get('REK_PASSTHROUGH_MAX_PX', 4096)),
+        'dead_letter_after': int(os.environ.get('IMAGE_DEAD_LETTER_AFTER', 3)),
+        'checkpoint_every': int(os.environ.get('CHECKPOINT_EVERY', 50)),
+        # Unflushed counter markers older than this (the longest a Lambda can run) are adopted
+        'adopt_after': int(os.environ.get('COUNTER_ADOPT_AFTER', 900)),
+        'progress_ttl_days': float(os.environ.get('BATCH_PROGRESS_TTL_DAYS', 14))
+    }
+    # Images held in memory per window; defaults to one per worker
+    settings['window'] = int(os.environ.get('IMAGE_WINDOW', settings['concurrency']))
+    # Clients are thread-safe, shared by every worker and kept across warm invocations
+    client_cfg = {
+        'retries': {'mode': 'adaptive', 'max_attempts': int(os.environ.get('AWS_RETRY_ATTEMPTS', 8))},
+        'max_pool_connections': max(10, settings['concurrency'] * 2)
     }
+    s3 = carnus_init.client('s3', **client_cfg)
+    rek = carnus_init.client('rekognition', **client_cfg)
+    table = carnus_init.table(**client_cfg)
     for record in event['Records']:
         bucket = record['s3']['bucket']['name']
         key = unquote_plus(record['s3']['object']['key'])
-        obj = s3.get_object(Bucket=bucket, Key=key)
-        payload = json.loads(obj['Body'].read().decode('utf-8'))
+        # Stage timings and AWS usage are reported per batch
+        metrics = carnus_metrics.begin('Processor')
+        settings['label_cache'] = LabelCache(
+            table,
+            ttl_days=float(os.environ.get('LABEL_CACHE_TTL_DAYS', 30)),
+            enabled=os.environ.get('LABEL_CACHE', 'true').lower() == 'true'
+        )
+        with carnus_metrics.stage('S3Get'):
+            obj = s3.get_object(Bucket=bucket, Key=key)
 
         key_parts = key.split('/')
         path_user_id = key_parts[1] if len(key_parts) > 1 else None
-        payload_user_id = payload.get('user_id')
+        payload_user_id, images = open_payload(
+            obj['Body'],
+            lambda dict_id: load_dictionary(s3, bucket, path_user_id, dict_id)
+        )
 
         if path_user_id and payload_user_id and path_user_id != payload_user_id:
-            raise ValueError(f"Identity Mismatch! Path ID ({path_user_id}) != Payload ID ({payload_user_id})")
+            # No retry can fix this, so the blob is set aside instead of raising into a replay
+            quarantine = f"{DEAD_LETTER_PREFIX}{path_user_id}/{os.path.basename(key)}"
+            s3.copy_object(Bucket=bucket, Key=quarantine, CopySource={'Bucket': bucket, 'Key': key})
+            if not settings.get('debug'):
+                write_dead_marker(s3, bucket, key)
+                s3.delete_object(Bucket=bucket, Key=key)
+            print(f"❌ Identity Mismatch! Path ID ({path_user_id}) != Payload ID ({payload_user_id}); moved to {quarantine}")
+            metrics.add('BatchesQuarantined', 1)
+            metrics.add('BatchBytes', obj.get('ContentLength', 0), 'Bytes')
+            metrics.set(Batch=key, Status='QUARANTINED')
+            metrics.emit()
+            continue
 
         user_id = path_user_id or payload_user_id or 'unknown'
+        progress = BatchProgress(table, user_id, bucket, key, obj.get('ETag', '').strip('"'), settings).load()
         
         if settings.get('debug'):
-            print(f"🚀 [PROCESS] User: {user_id} | Batch Size: {len(payload.get('images', []))} images")
+            print(f"🚀 [PROCESS] User: {user_id} | Batch: {key} ({obj.get('ContentLength', 0)} bytes) | "
+                  f"{len(progress.done)} done, {len(progress.dead)} dead-lettered earlier")
 
-        for img in payload.get('images', []):
-            process_image(img, user_id, settings, s3, rek, table)
+        counters = CounterDeltas()
+        status = 'IN_PROGRESS'
+        try:
+            adopted = counters.adopt(user_id, table, settings['adopt_after'])
+            if adopted: print(f"🧮 [COUNTERS] Adopted {adopted} unflushed image delta(s) from an earlier invocation")
+            failed = process_batch(images, user_id, settings, s3, rek, table, counters, progress)
+            if not failed: status = 'COMPLETE'
+        finally:
+            try:
+                # Checkpointed before any retry is requested (even a truncated stream), since a retry skips these images
+                checkpoint(progress, counters, user_id, table, settings, status)
+            finally:
+                # Emitted for failed batches too
+                cache = settings['label_cache']
+                metrics.add('RekognitionCacheHits', cache.hits)
+                metrics.add('RekognitionCacheMisses', cache.misses)
+                metrics.add('ImagesDeadLettered', len(progress.dead))
+                metrics.add('BatchBytes', obj.get('ContentLength', 0), 'Bytes')
+                metrics.set(Batch=key, Status=status)
+                metrics.emit()
+        if cache.enabled: print(f"🏷️ [CACHE] Rekognition hits: {cache.hits} | misses: {cache.misses}")
+        if failed:
+            # Keep the blob and let the S3 retry resume it; settled images are skipped
+            raise RuntimeError(f"{len(failed)} image(s) failed in {key}: {', '.join(f for f, _ in failed)}")
+        if progress.dead:
+            print(f"🪦 [DEAD LETTER] {len(progress.dead)} image(s) of {key} set aside under {DEAD_LETTER_PREFIX}{user_id}/")
 
         if not settings.get('debug'):
+            # Written before the delete, so a retry after a crash in between writes it again
+            if progress.dead: write_dead_marker(s3, bucket, key, {o: progress.dead_files.get(o) for o in progress.dead})
             s3.delete_object(Bucket=bucket, Key=key)
         else:
             print(f"💾 [DEBUG] Preserving blob: {key}")
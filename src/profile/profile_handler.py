@@ -1,10 +1,12 @@
 import json
-import boto3
 import os
 import time
 import base64
 from decimal import Decimal
 from botocore.exceptions import ClientError
+import carnus_init
+import carnus_metrics
+import carnus_presign
 
 # Handle DynamoDB Numbers (Decimals) for JSON serialization
 class DecimalEncoder(json.JSONEncoder):
@@ -13,11 +15,9 @@ class DecimalEncoder(json.JSONEncoder):
             return int(obj) if obj % 1 == 0 else float(obj)
         return super(DecimalEncoder, self).default(obj)
 
-dynamodb = boto3.resource('dynamodb')
-s3 = boto3.client('s3')
-table = dynamodb.Table(os.environ['TABLE_NAME'])
 bucket_name = os.environ['THUMB_BUCKET']
 
+@carnus_metrics.metered('Profile')
 def handler(event, context):
     user_id = event['requestContext']['authorizer']['principalId']
     method = event['httpMethod']
@@ -25,10 +25,13 @@ def handler(event, context):
 
     pk = f"USER#{user_id}#PROFILE"
     sk = "METADATA"
+    table = carnus_init.table()
+    s3 = carnus_init.client('s3')
 
     try:
         if method == 'GET':
-            response = table.get_item(Key={'PK': pk, 'SK': sk})
+            with carnus_metrics.stage('DynamoDB'):
+                response = table.get_item(Key={'PK': pk, 'SK': sk})
             # Default to email from claims if record is missing (Fixes Stuart)
             item = response.get('Item', {'Email': claims.get('email', 'Unknown')})
 
@@ -40,10 +43,10 @@ def handler(event, context):
             if item.get('AvatarUrl'):
                 avatar_key = item['AvatarUrl']
                 try:
-                    item['AvatarUrl'] = s3.generate_presigned_url('get_object', Params={
-                        'Bucket': bucket_name,
-                        'Key': avatar_key
-                    }, ExpiresIn=3600)
+                    # The avatar key is reused, so its update time keeps a new upload from a cached URL
+                    item['AvatarUrl'] = carnus_presign.presigned_get(
+                        bucket_name, avatar_key, expires_in=3600, version=item.get('AvatarUpdatedAt')
+                    )
                 except Exception:
                     item.pop('AvatarUrl', None)
             else:
@@ -64,7 +67,8 @@ def handler(event, context):
             body = json.loads(event.get('body', '{}')) if event.get('body') else {}
             is_avatar_action = 'AvatarBlob' in body or body.get('DeleteAvatar')
 
-            existing = table.get_item(Key={'PK': pk, 'SK': sk}).get('Item', {})
+            with carnus_metrics.stage('DynamoDB'):
+                existing = table.get_item(Key={'PK': pk, 'SK': sk}).get('Item', {})
 
             if is_avatar_action:
                 last_update = existing.get('AvatarUpdatedAt', 0)
@@ -79,11 +83,12 @@ def handler(event, context):
                         s3.delete_object(Bucket=bucket_name, Key=f"avatars/{user_id}.jpg")
                     except Exception: pass
 
-                    table.update_item(
-                        Key={'PK': pk, 'SK': sk},
-                        UpdateExpression="REMOVE AvatarUrl SET AvatarUpdatedAt = :t",
-                        ExpressionAttributeValues={':t': int(time.time())}
-                    )
+                    with carnus_metrics.stage('DynamoDB'):
+                        table.update_item(
+                            Key={'PK': pk, 'SK': sk},
+                            UpdateExpression="REMOVE AvatarUrl SET AvatarUpdatedAt = :t",
+                            ExpressionAttributeValues={':t': int(time.time())}
+                        )
                     return {
                         'statusCode': 200,
                         'body': json.dumps({'message': 'Avatar deleted'})
@@ -114,12 +119,13 @@ def handler(event, context):
                 attr_vals[':u'] = f"avatars/{user_id}.jpg"
                 attr_vals[':t'] = int(time.time())
 
-            response = table.update_item(
-                Key={'PK': pk, 'SK': sk},
-                UpdateExpression=update_expr,
-                ExpressionAttributeValues=attr_vals,
-                ReturnValues="ALL_NEW"
-            )
+            with carnus_metrics.stage('DynamoDB'):
+                response = table.update_item(
+                    Key={'PK': pk, 'SK': sk},
+                    UpdateExpression=update_expr,
+                    ExpressionAttributeValues=attr_vals,
+                    ReturnValues="ALL_NEW"
+                )
 
             updated_item = response.get('Attributes', {})
             
@@ -0,0 +1,81 @@
+"""Lazy initialization shared by every Carnus Lambda (deployed as SharedLayer).
+
+Clients, resources and tables are built on first use and then reused for the
+life of the warm container. A cold start only pays for what an invocation
+actually touches, and importing a handler stays cheap. Heavy optional modules
+(PIL, brotli, zstandard, ...) can be bound at import time with lazy_import()
+and are only loaded when first used. Every client reports its calls to
+carnus_metrics.
+"""
+import os
+import importlib
+import threading
+import carnus_metrics
+
+_lock = threading.RLock()
+_cache = {}
+
+def _memo(key, build):
+    try:
+        return _cache[key]
+    except KeyError:
+        pass
+    with _lock:
+        if key not in _cache:
+            _cache[key] = build()
+        return _cache[key]
+
+# --- AWS ---
+def session():
+    """One botocore session per container; creating clients from it is thread-safe."""
+    def build():
+        import boto3
+        return boto3.session.Session()
+    return _memo('session', build)
+
+def _config(options):
+    if not options: return None
+    from botocore.config import Config
+    return Config(**options)
+
+def client(service, **config):
+    """Returns the shared `service` client; keyword args become a botocore Config."""
+    key = ('client', service, repr(sorted(config.items())))
+    return _memo(key, lambda: carnus_metrics.instrument(session().client(service, config=_config(config))))
+
+def resource(service, **config):
+    key = ('resource', service, repr(sorted(config.items())))
+    def build():
+        res = session().resource(service, config=_config(config))
+        carnus_metrics.instrument(res.meta.client)
+        return res
+    return _memo(key, build)
+
+def table(name=None, **config):
+    """Returns the shared DynamoDB Table (TABLE_NAME by default)."""
+    name = name or os.environ['TABLE_NAME']
+    key = ('table', name, repr(sorted(config.items())))
+    return _memo(key, lambda: resource('dynamodb', **config).Table(name))
+
+# --- DEFERRED IMPORTS ---
+class _LazyModule:
+    """Module stand-in that imports the real module on first attribute access."""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r}{' (loaded)' if self._module else ''}>"
+
+def lazy_import(name):
+    return _LazyModule(name)
+
+def reset():
+    """Drops every cached client; used by local harnesses between runs."""
+    with _lock:
+        _cache.clear()
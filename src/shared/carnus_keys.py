@@ -0,0 +1,40 @@
+"""Sort keys of tag posting rows (USER#{id}#TAG#{tag}), shared by the processor, the API and migrations.
+
+Rows sort by capture time: SK = "DATE#{CaptureDate}#IMAGE#{image_id}".
+CaptureDate is an ISO 8601 string, so key order is chronological and a date
+range is a single key condition. The image id breaks ties, and the same image
+has the same key in every tag it carries. Rows written before this layout use
+SK = "IMAGE#{image_id}" until migrate_tag_sort_keys.py rewrites them.
+"""
+import re
+
+TAG_SORT_PREFIX = "DATE#"
+LEGACY_PREFIX = "IMAGE#"
+# Sorts after every character of an ISO date, so an upper bound includes the whole day/month/year
+_INCLUSIVE = "~"
+_DATE = re.compile(r'^\d{4}(-\d{2}(-\d{2}([T ][0-9:.]+)?)?)?$')
+
+def tag_sort_key(capture_date, image_id):
+    return f"{TAG_SORT_PREFIX}{capture_date}#IMAGE#{image_id}"
+
+def legacy_sort_key(image_id):
+    return f"{LEGACY_PREFIX}{image_id}"
+
+def image_id_of(sk):
+    """Returns the image id of either key layout."""
+    return sk.rsplit('#IMAGE#', 1)[1] if '#IMAGE#' in sk else sk[len(LEGACY_PREFIX):]
+
+def valid_date(value):
+    """True for ISO date prefixes: 2024, 2024-05, 2024-05-17 or 2024-05-17T10:00."""
+    return bool(_DATE.match(value))
+
+def date_bounds(date_from=None, date_to=None):
+    """Returns inclusive (low, high) sort keys for a capture date range; an open end is None."""
+    low = f"{TAG_SORT_PREFIX}{date_from.replace(' ', 'T')}" if date_from else None
+    high = f"{TAG_SORT_PREFIX}{date_to.replace(' ', 'T')}{_INCLUSIVE}" if date_to else None
+    return low, high
+
+def dated_bounds(date_from=None, date_to=None):
+    """Like date_bounds, but open ends cover every dated key (legacy rows fall outside)."""
+    low, high = date_bounds(date_from, date_to)
+    return low or TAG_SORT_PREFIX, high or f"{TAG_SORT_PREFIX}{_INCLUSIVE}"
@@ -0,0 +1,158 @@
+"""Hot-path metrics for every Carnus Lambda (deployed with SharedLayer).
+
+A Metrics object collects stage timings, counts and AWS usage for one
+invocation (or one processor batch), and emit() prints them as a single
+CloudWatch Embedded Metric Format line. CloudWatch Logs turns that line into
+metrics, so reporting costs no API calls. Clients built by carnus_init report
+every call and the bytes it moved into the active Metrics, so backend usage
+is counted without touching call sites. Per-operation call counts and stage
+counts are logged as properties (queryable in Logs Insights) rather than
+published as metrics, which keeps the metric count small.
+"""
+import os
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'Carnus')
+ENABLED = os.environ.get('METRICS', 'true').lower() == 'true'
+# EMF accepts at most 100 metrics per document
+MAX_METRICS = 100
+
+# The Metrics receiving stage timings and AWS calls; one invocation runs at a time per container
+_active = None
+
+class Metrics:
+    """Thread-safe totals for one unit of work, emitted as one EMF document."""
+    def __init__(self, service, **dimensions):
+        self.dimensions = {'Service': service, **dimensions}
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.values = {}
+        self.stages = {}
+        self.calls = {}
+        self.properties = {}
+
+    def add(self, name, value=1, unit='Count'):
+        with self.lock:
+            total, _ = self.values.get(name, (0, unit))
+            self.values[name] = (total + value, unit)
+
+    def record_stage(self, name, ms):
+        self.add(f"{name}Time", ms, 'Milliseconds')
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0) + 1
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, (time.perf_counter() - t0) * 1e3)
+
+    def record_call(self, service, operation, sent=0):
+        with self.lock:
+            op = f"{service}.{operation}"
+            self.calls[op] = self.calls.get(op, 0) + 1
+        self.add(f"{service}Calls")
+        if sent: self.add(f"{service}BytesSent", sent, 'Bytes')
+
+    def set(self, **properties):
+        with self.lock:
+            self.properties.update(properties)
+
+    def document(self):
+        """Returns the EMF document for everything recorded so far."""
+        self.add('Duration', (time.perf_counter() - self.started) * 1e3, 'Milliseconds')
+        with self.lock:
+            values = dict(sorted(self.values.items())[:MAX_METRICS])
+            return {
+                '_aws': {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': NAMESPACE,
+                        'Dimensions': [sorted(self.dimensions)],
+                        'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in values.items()]
+                    }]
+                },
+                **self.dimensions,
+                **self.properties,
+                'StageCounts': dict(self.stages),
+                'Calls': dict(self.calls),
+                **{name: round(total, 3) for name, (total, _) in values.items()}
+            }
+
+    def emit(self):
+        if ENABLED: print(json.dumps(self.document(), default=str))
+
+# --- ACTIVE METRICS ---
+def begin(service, **dimensions):
+    """Starts a new Metrics and makes it the one stages and AWS calls report to."""
+    global _active
+    _active = Metrics(service, **dimensions)
+    return _active
+
+def add(name, value=1, unit='Count'):
+    if _active is not None: _active.add(name, value, unit)
+
+@contextmanager
+def stage(name):
+    """Times the block into the active Metrics as `{name}Time`; a no-op without one."""
+    metrics = _active
+    if metrics is None:
+        yield
+        return
+    with metrics.stage(name):
+        yield
+
+def metered(service):
+    """Decorates a Lambda handler: one Metrics per invocation, emitted with the status code."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(event, context):
+            metrics = begin(service)
+            response = None
+            try:
+                response = fn(event, context)
+                return response
+            finally:
+                # No response means the handler raised
+                status = response.get('statusCode', 200) if isinstance(response, dict) else (500 if response is None else 200)
+                metrics.set(StatusCode=status)
+                metrics.add('Errors', int(status >= 500))
+                metrics.emit()
+        return wrapper
+    return decorator
+
+# --- CLIENT HOOKS ---
+def _body_size(body):
+    if isinstance(body, (bytes, bytearray, str)): return len(body)
+    # S3 bodies arrive as seekable file objects; measure what is left to send
+    if hasattr(body, 'seek') and hasattr(body, 'tell'):
+        pos = body.tell()
+        size = body.seek(0, os.SEEK_END)
+        body.seek(pos)
+        return size - pos
+    return 0
+
+def _before_call(model, params, **kwargs):
+    if _active is None: return
+    _active.record_call(model.service_model.service_id, model.name, sent=_body_size(params.get('body')))
+
+def _after_call(http_response, model, **kwargs):
+    if _active is None or http_response is None: return
+    received = http_response.headers.get('Content-Length')
+    if received is None and not model.has_streaming_output:
+        # Non-streaming bodies are already read; streaming ones must not be touched here
+        received = len(http_response.content)
+    received = int(received or 0)
+    if received: _active.add(f"{model.service_model.service_id}BytesReceived", received, 'Bytes')
+
+def instrument(client):
+    """Reports every call `client` makes (and the bytes it moves) to the active Metrics."""
+    client.meta.events.register('before-call', _before_call)
+    client.meta.events.register('after-call', _after_call)
+    return client
@@ -0,0 +1,68 @@
+"""Presigned S3 GET URLs that stay identical for a whole expiry window.
+
+Time is cut into fixed windows (PRESIGN_WINDOW_SECONDS). The first request for
+an object in a window signs a URL that expires `expires_in` seconds after the
+window closes, so it is valid for at least `expires_in` whenever it is handed
+out. The URL is then memoized in an LRU for the life of the warm container, so
+every page in that window gets the same URL and browsers can serve repeat
+views from cache (the URL asks S3 for a matching Cache-Control). Passing a
+`version` (e.g. an update timestamp) re-signs objects whose key is reused.
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+import carnus_init
+import carnus_metrics
+
+WINDOW = int(os.environ.get('PRESIGN_WINDOW_SECONDS', 900))
+CACHE_SIZE = int(os.environ.get('PRESIGN_CACHE_SIZE', 4096))
+
+class LRUCache:
+    """Thread-safe least-recently-used map with a fixed number of entries."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None: self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+_urls = LRUCache(CACHE_SIZE)
+
+def presigned_get(bucket, key, expires_in=900, version=None, now=None):
+    """Returns a GET URL for s3://bucket/key valid for at least `expires_in` seconds, or None without a key."""
+    if not key: return None
+    now = time.time() if now is None else now
+    window = int(now // WINDOW)
+    cache_key = (bucket, key, expires_in, version, window)
+    url = _urls.get(cache_key)
+    if url is not None:
+        carnus_metrics.add('PresignCacheHits')
+        return url
+
+    carnus_metrics.add('PresignCacheMisses')
+    # Expiry rounded up to the window's end; browsers may cache for as long as any URL of the window lives
+    expires = int((window + 1) * WINDOW + expires_in - now)
+    with carnus_metrics.stage('Presign'):
+        url = carnus_init.client('s3', signature_version='s3v4').generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket, 'Key': key, 'ResponseCacheControl': f"private, max-age={WINDOW + expires_in}"},
+            ExpiresIn=expires
+        )
+    _urls.put(cache_key, url)
+    return url
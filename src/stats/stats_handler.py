@@ -1,29 +1,38 @@
 import json
 import os
-import boto3
 import time
 from collections import Counter
+import carnus_init
+import carnus_metrics
 
 # Core Model: Gemini 3 Flash / Free Tier
-dynamodb = boto3.resource('dynamodb')
 TABLE_NAME = os.environ.get('TABLE_NAME')
-INDEX_NAME = 'ImageIdIndex'
-table = dynamodb.Table(TABLE_NAME)
+INDEX_NAME = 'ImageStatsIndex'
 
+@carnus_metrics.metered('Stats')
 def handler(event, context):
     try:
         # 1. READ FROM INDEX
         # We scan the GSI to get only projected image metadata, bypassing TAG# rows
-        response = table.scan(IndexName=INDEX_NAME)
+        # Only the attributes aggregated below (the index projects nothing else)
+        table = carnus_init.table(TABLE_NAME)
+        scan_args = {
+            'IndexName': INDEX_NAME,
+            'ProjectionExpression': "PK, CameraModel, Labels, CaptureDate"
+        }
+        with carnus_metrics.stage('DynamoDB'):
+            response = table.scan(**scan_args)
         items = response.get('Items', [])
 
         # Handle DynamoDB pagination (1MB limit)
         while 'LastEvaluatedKey' in response:
-            response = table.scan(
-                IndexName=INDEX_NAME,
-                ExclusiveStartKey=response['LastEvaluatedKey']
-            )
+            with carnus_metrics.stage('DynamoDB'):
+                response = table.scan(
+                    ExclusiveStartKey=response['LastEvaluatedKey'],
+                    **scan_args
+                )
             items.extend(response.get('Items', []))
+        carnus_metrics.add('ItemsScanned', len(items))
 
         # 2. AGGREGATE DATA
         # We track by PK (filename) to reach the 266 count confirmed by CLI
@@ -1,11 +1,16 @@
 import json
-import boto3
 import os
 import base64
 import urllib.parse
-from boto3.dynamodb.conditions import Key
 from decimal import Decimal
-from botocore.config import Config
+import carnus_init
+import carnus_metrics
+import carnus_presign
+import carnus_keys
+import tag_search
+
+# boto3 is only loaded when a query is built, not at cold start
+conditions = carnus_init.lazy_import('boto3.dynamodb.conditions')
 
 # Handle DynamoDB Numbers (Decimals) for JSON serialization
 class DecimalEncoder(json.JSONEncoder):
@@ -14,23 +19,80 @@ class DecimalEncoder(json.JSONEncoder):
             return int(obj) if obj % 1 == 0 else float(obj)
         return super(DecimalEncoder, self).default(obj)
 
-# Initialize clients
-s3_client = boto3.client('s3', config=Config(signature_version='s3v4'))
-dynamodb = boto3.resource('dynamodb')
-
-table = dynamodb.Table(os.environ['TABLE_NAME'])
+# Clients come from the shared layer on first use
 THUMB_BUCKET = os.environ['THUMB_BUCKET']
+# DynamoDB queries one search page may spend before returning what it has
+SEARCH_MAX_QUERIES = int(os.environ.get('SEARCH_MAX_QUERIES', 100))
 
 def generate_presigned_url(s3_key):
-    """Generates a 15-minute temporary link for the private S3 object"""
-    if not s3_key:
+    """Generates a link valid for at least 15 minutes; repeat tiles in a window reuse it (browser cache hits)"""
+    return carnus_presign.presigned_get(THUMB_BUCKET, s3_key, expires_in=900)
+
+def bad_request(message):
+    return {
+        "statusCode": 400,
+        "body": json.dumps({"error": message})
+    }
+
+def encode_cursor(last_key):
+    """Pages resume from the last sort key; the partition always comes from the request"""
+    return base64.urlsafe_b64encode(last_key['SK'].encode()).decode() if last_key else None
+
+def decode_cursor(token):
+    """Returns the sort key to resume after, or None to restart at the first page."""
+    sk = base64.urlsafe_b64decode(token.encode()).decode()
+    if sk.startswith('{'):
+        # Tokens issued before date ordering were a whole LastEvaluatedKey in IMAGE# order,
+        # which no longer lines up with any page; drop this branch once they have expired
+        if 'SK' not in json.loads(sk): raise ValueError("not a gallery token")
         return None
-    return s3_client.generate_presigned_url(
-        'get_object',
-        Params={'Bucket': THUMB_BUCKET, 'Key': s3_key},
-        ExpiresIn=900
-    )
+    if not sk.startswith((carnus_keys.TAG_SORT_PREFIX, carnus_keys.LEGACY_PREFIX)):
+        raise ValueError("not a tag posting key")
+    return sk
+
+def search_images(user_id, query_params):
+    """GET /search?q=Mountain AND Sunset AND NOT Person, with the gallery's from/to/order/next_token"""
+    q = query_params.get('q')
+    if not q:
+        return bad_request("q is required, e.g. Mountain AND (Sunset OR Sunrise) AND NOT Person")
+    date_from, date_to = query_params.get('from'), query_params.get('to')
+    order = (query_params.get('order') or 'desc').lower()
+    if order not in ('asc', 'desc'):
+        return bad_request("order must be asc or desc")
+    if any(d and not carnus_keys.valid_date(d) for d in (date_from, date_to)):
+        return bad_request("from/to must be ISO dates (YYYY, YYYY-MM, YYYY-MM-DD or YYYY-MM-DDTHH:MM)")
+    try:
+        limit = int(query_params.get('limit') or 50)
+    except ValueError:
+        return bad_request("limit must be a number")
+    if not 1 <= limit <= 100:
+        return bad_request("limit must be between 1 and 100")
 
+    try:
+        query, rows, next_token = tag_search.search(
+            carnus_init.table(), user_id, q, date_from, date_to, order, limit,
+            query_params.get('next_token'), budget=SEARCH_MAX_QUERIES)
+    except tag_search.SearchError as e:
+        return bad_request(str(e))
+
+    items = [{
+        "ImageId": row.get('ImageId') or carnus_keys.image_id_of(row['SK']),
+        "ImageName": row.get('ImageName'),
+        "CaptureDate": row.get('Timestamp'),
+        "ThumbnailUrl": generate_presigned_url(row.get('GridKey') or row.get('ThumbnailKey'))
+    } for row in rows]
+
+    return {
+        "statusCode": 200,
+        "headers": { "Content-Type": "application/json" },
+        "body": json.dumps({
+            "query": query,
+            "items": items,
+            "next_token": next_token
+        }, cls=DecimalEncoder)
+    }
+
+@carnus_metrics.metered('Tags')
 def handler(event, context):
     user_id = event['requestContext']['authorizer']['principalId']
     path_params = event.get('pathParameters') or {}
@@ -38,34 +100,61 @@ def handler(event, context):
     raw_tag = path_params.get('tag_name')
 
     try:
+        if event.get('resource') == '/search':
+            return search_images(user_id, query_params)
+
         if raw_tag:
             # GALLERY VIEW: GET /tags/{tag_name}
+            # ?from=2024-05&to=2024-06-30 bounds capture dates (inclusive), ?order=asc|desc (newest first by default)
             decoded_tag = urllib.parse.unquote(raw_tag)
             search_pk = f"USER#{user_id}#TAG#{decoded_tag}"
+            date_from, date_to = query_params.get('from'), query_params.get('to')
+            order = (query_params.get('order') or 'desc').lower()
+            if order not in ('asc', 'desc'):
+                return bad_request("order must be asc or desc")
+            if any(d and not carnus_keys.valid_date(d) for d in (date_from, date_to)):
+                return bad_request("from/to must be ISO dates (YYYY, YYYY-MM, YYYY-MM-DD or YYYY-MM-DDTHH:MM)")
+
+            key_condition = conditions.Key('PK').eq(search_pk)
+            low, high = carnus_keys.date_bounds(date_from, date_to)
+            if low and high:
+                key_condition &= conditions.Key('SK').between(low, high)
+            elif low:
+                key_condition &= conditions.Key('SK').gte(low)
+            elif high:
+                key_condition &= conditions.Key('SK').lte(high)
+            # Unbounded galleries also return unmigrated legacy IMAGE# rows, which sort apart from the dated ones
 
             query_args = {
-                "KeyConditionExpression": Key('PK').eq(search_pk),
+                "KeyConditionExpression": key_condition,
+                "ScanIndexForward": order == 'asc',
                 "Limit": 50
             }
 
             next_token = query_params.get('next_token')
             if next_token:
-                query_args["ExclusiveStartKey"] = json.loads(base64.b64decode(next_token).decode())
+                try:
+                    resume_sk = decode_cursor(next_token)
+                except ValueError:
+                    return bad_request("Invalid next_token")
+                if resume_sk: query_args["ExclusiveStartKey"] = {'PK': search_pk, 'SK': resume_sk}
 
-            response = table.query(**query_args)
+            with carnus_metrics.stage('DynamoDB'):
+                response = carnus_init.table().query(**query_args)
 
             clean_items = []
             for item in response.get('Items', []):
-                s3_key = item.get('ThumbnailKey')
+                # Grid tiles; rows written before derivatives fall back to the full preview
+                s3_key = item.get('GridKey') or item.get('ThumbnailKey')
                 clean_items.append({
-                    "ImageId": item['SK'].replace("IMAGE#", ""),
+                    "ImageId": item.get('ImageId') or carnus_keys.image_id_of(item['SK']),
                     'ImageName': item.get('ImageName'),
+                    "CaptureDate": item.get('Timestamp'),
                     "Tag": decoded_tag,
                     "ThumbnailUrl": generate_presigned_url(s3_key)
                 })
 
-            last_key = response.get('LastEvaluatedKey')
-            encoded_token = base64.b64encode(json.dumps(last_key).encode()).decode() if last_key else None
+            encoded_token = encode_cursor(response.get('LastEvaluatedKey'))
 
             return {
                 "statusCode": 200,
@@ -79,7 +168,8 @@ def handler(event, context):
         else:
             # TAG CLOUD VIEW: GET /tags
             pk = f"USER#{user_id}#TAG_CLOUD"
-            response = table.query(KeyConditionExpression=Key('PK').eq(pk))
+            with carnus_metrics.stage('DynamoDB'):
+                response = carnus_init.table().query(KeyConditionExpression=conditions.Key('PK').eq(pk))
 
             data = []
             for i in response.get('Items', []):
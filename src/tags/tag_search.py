@@ -0,0 +1,446 @@
+"""Boolean tag search (GET /search?q=...) over the date-ordered tag posting lists.
+
+Each tag of a user is a posting list: its USER#{id}#TAG#{tag} partition, sorted
+by carnus_keys.tag_sort_key. An image has the same sort key in every tag, so a
+query such as `Mountain AND Sunset AND NOT Person` is answered by walking the
+partitions side by side in key order:
+
+* AND leapfrogs. The list with the smallest TAG_CLOUD count drives, the others
+  seek to its key, and a list that overshoots moves the driver up to its key.
+  A seek inside the page already read gallops (exponential, then binary
+  search); a seek past it starts a new Query at the target, so the pages in
+  between are never read. Reads follow the rarest tag, not the sum of lists.
+* OR merges its children in key order, cheapest first. A costlier child only
+  searches up to the next key a cheaper one already has (a bounded peek).
+* NOT is only allowed inside an AND, where it is a seek to the candidate key.
+
+A page ends after `limit` results or when the Query budget runs out, but the
+budget only stops a page once it has moved past where it started, so paging
+always ends. Either way the cursor is one sort key (plus whether it was already
+returned): every list resumes by seeking to it. Only migrated (DATE#) rows are
+searched.
+"""
+import re
+import json
+import base64
+import hashlib
+import carnus_init
+import carnus_metrics
+import carnus_keys
+
+conditions = carnus_init.lazy_import('boto3.dynamodb.conditions')
+
+MAX_TAGS = 10
+# Seeks read small pages; sequential reads double up to MAX_PAGE
+FIRST_PAGE = 16
+MAX_PAGE = 512
+# Returned by frontier() once a stream has nothing left
+EXHAUSTED = object()
+
+class SearchError(ValueError):
+    """A query or cursor the endpoint answers with a 400."""
+
+class BudgetExceeded(Exception):
+    """Raised before a Query past the request's budget, once the page has made progress."""
+
+# --- PARSER ---
+# Expression nodes: ('tag', name) | ('and', [nodes]) | ('or', [nodes]) | ('not', node)
+_TOKEN = re.compile(r'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+_OPERATORS = ('AND', 'OR', 'NOT')
+
+def tokenize(q):
+    """Splits a query into ('(', ')', 'AND', 'OR', 'NOT' or 'TAG', value) tokens; quote tags with spaces."""
+    tokens, pos, q = [], 0, q.strip()
+    while pos < len(q):
+        m = _TOKEN.match(q, pos)
+        if not m:
+            raise SearchError(f"Cannot parse query near {q[pos:pos + 20]!r}")
+        pos = m.end()
+        lpar, rpar, quoted, word = m.groups()
+        if lpar: tokens.append(('(', None))
+        elif rpar: tokens.append((')', None))
+        elif quoted is not None: tokens.append(('TAG', re.sub(r'\\(.)', r'\1', quoted)))
+        elif word in _OPERATORS: tokens.append((word, None))
+        else: tokens.append(('TAG', word))
+    return tokens
+
+def _join(op, nodes):
+    flat = []
+    for node in nodes:
+        flat.extend(node[1] if node[0] == op else [node])
+    return flat[0] if len(flat) == 1 else (op, flat)
+
+class _Parser:
+    """Precedence NOT > AND > OR; adjacent terms are ANDed."""
+    def __init__(self, tokens):
+        self.tokens, self.i = tokens, 0
+
+    def peek(self):
+        return self.tokens[self.i][0] if self.i < len(self.tokens) else None
+
+    def take(self):
+        self.i += 1
+        return self.tokens[self.i - 1]
+
+    def parse(self):
+        if not self.tokens:
+            raise SearchError("Empty query")
+        node = self.or_()
+        if self.peek() is not None:
+            raise SearchError(f"Unexpected {self.peek()}")
+        return node
+
+    def or_(self):
+        nodes = [self.and_()]
+        while self.peek() == 'OR':
+            self.take()
+            nodes.append(self.and_())
+        return _join('or', nodes)
+
+    def and_(self):
+        nodes = [self.unary()]
+        while self.peek() in ('AND', 'NOT', 'TAG', '('):
+            if self.peek() == 'AND': self.take()
+            nodes.append(self.unary())
+        return _join('and', nodes)
+
+    def unary(self):
+        if self.peek() != 'NOT':
+            return self.primary()
+        self.take()
+        node = self.unary()
+        return node[1] if node[0] == 'not' else ('not', node)
+
+    def primary(self):
+        kind = self.peek()
+        if kind == '(':
+            self.take()
+            node = self.or_()
+            if self.peek() != ')':
+                raise SearchError("Missing )")
+            self.take()
+            return node
+        if kind == 'TAG':
+            return ('tag', self.take()[1])
+        raise SearchError(f"Expected a tag, got {kind}" if kind else "Expected a tag at the end of the query")
+
+def parse(q):
+    return _Parser(tokenize(q)).parse()
+
+def tags_of(node):
+    if node[0] == 'tag': return {node[1]}
+    if node[0] == 'not': return tags_of(node[1])
+    return set().union(*(tags_of(child) for child in node[1]))
+
+def describe(node):
+    """Canonical text of a parsed query (echoed to clients and bound into cursors)."""
+    if node[0] == 'tag': return json.dumps(node[1], ensure_ascii=False)
+    if node[0] == 'not': return f"NOT {describe(node[1])}"
+    return "(" + f" {node[0].upper()} ".join(describe(child) for child in node[1]) + ")"
+
+# --- CURSOR ---
+def fingerprint(node, order, date_from, date_to):
+    text = json.dumps([describe(node), order, date_from, date_to])
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+def encode_cursor(query_id, key, returned):
+    """`returned` means `key` was on the last page, so the next page starts after it."""
+    body = json.dumps({'q': query_id, 'k': key, 'x': int(returned)}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(body.encode()).decode()
+
+def decode_cursor(token, query_id):
+    try:
+        body = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+        key, returned = body['k'], bool(body['x'])
+    except (ValueError, TypeError, KeyError):
+        raise SearchError("Invalid next_token")
+    if body.get('q') != query_id:
+        raise SearchError("next_token belongs to a different search")
+    if not isinstance(key, str) or not key.startswith(carnus_keys.TAG_SORT_PREFIX):
+        raise SearchError("Invalid next_token")
+    return key, returned
+
+# --- POSTING LISTS ---
+class SearchContext:
+    """Shared by every list of one search: key order, date bounds and the Query budget."""
+    def __init__(self, table, user_id, ascending, date_from=None, date_to=None, budget=100):
+        self.table, self.user_id, self.ascending, self.budget = table, user_id, ascending, budget
+        self.low, self.high = carnus_keys.dated_bounds(date_from, date_to)
+        self.queries = 0
+        # The budget is only enforced once this says the page moved forward
+        self.progressed = lambda: True
+
+    def before(self, a, b):
+        return a < b if self.ascending else a > b
+
+    def first(self, keys):
+        return min(keys) if self.ascending else max(keys)
+
+    def last(self, keys):
+        return max(keys) if self.ascending else min(keys)
+
+    def query(self, pk, limit, start=None, exclusive_start=None):
+        """One page of a posting list, from `start` (inclusive) or after `exclusive_start`."""
+        low, high = self.low, self.high
+        if start is not None:
+            if self.ascending: low = max(low, start)
+            else: high = min(high, start)
+        if low > high:
+            return [], None
+        if self.queries >= self.budget and self.progressed():
+            raise BudgetExceeded()
+        self.queries += 1
+        args = {
+            'KeyConditionExpression': conditions.Key('PK').eq(pk) & conditions.Key('SK').between(low, high),
+            'ScanIndexForward': self.ascending,
+            'Limit': limit
+        }
+        if exclusive_start: args['ExclusiveStartKey'] = exclusive_start
+        with carnus_metrics.stage('DynamoDB'):
+            resp = self.table.query(**args)
+        return resp.get('Items', []), resp.get('LastEvaluatedKey')
+
+class Postings:
+    """One tag's partition, read lazily in key order.
+
+    Streams share one interface: peek() is the current key (None when done),
+    row() its item, advance() moves past it, seek(key) moves to the first key
+    not before `key`, and frontier() is a key every earlier key of which has
+    been decided (None if unknown yet, EXHAUSTED if nothing is left).
+    peek(bound) may stop searching once it is past `bound` and return a key
+    after `bound` with nothing before it; otherwise the key is exact.
+    """
+    def __init__(self, ctx, tag, estimate):
+        self.ctx, self.tag, self.estimate = ctx, tag, estimate
+        self.pk = f"USER#{ctx.user_id}#TAG#{tag}"
+        self.rows, self.pos, self.more = [], 0, None
+        self.limit = FIRST_PAGE
+        self.start = None
+        self.loaded = self.done = False
+
+    def _fetch(self, start=None, grow=False):
+        # State only changes once the Query succeeds, so a BudgetExceeded leaves the stream consistent
+        if self.loaded and start is None:
+            if not self.more:
+                self.done = True
+                return
+            limit = min(self.limit * 2, MAX_PAGE)
+            rows, more = self.ctx.query(self.pk, limit, exclusive_start=self.more)
+        else:
+            limit = min(self.limit * 2, MAX_PAGE) if grow else FIRST_PAGE
+            rows, more = self.ctx.query(self.pk, limit, start=start)
+        self.rows, self.pos, self.more, self.limit, self.loaded = rows, 0, more, limit, True
+        if not rows:
+            if more: self._fetch()
+            else: self.done = True
+
+    def peek(self, bound=None):
+        if not self.loaded: self._fetch(self.start)
+        return None if self.done else self.rows[self.pos]['SK']
+
+    def row(self):
+        return self.rows[self.pos]
+
+    def advance(self):
+        if self.pos + 1 < len(self.rows): self.pos += 1
+        else: self._fetch()
+
+    def seek(self, target):
+        if not self.loaded:
+            # The first read can start right at the target
+            if self.start is None or self.ctx.before(self.start, target): self.start = target
+            return
+        before, rows = self.ctx.before, self.rows
+        if self.done or not before(rows[self.pos]['SK'], target):
+            return
+        if not before(rows[-1]['SK'], target):
+            # Gallop: double the step while still before the target, then bisect the last step
+            lo, step = self.pos, 1
+            while lo + step < len(rows) and before(rows[lo + step]['SK'], target):
+                lo += step
+                step *= 2
+            hi = min(lo + step, len(rows) - 1)
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if before(rows[mid]['SK'], target): lo = mid
+                else: hi = mid
+            self.pos = hi
+        elif self.more:
+            # Past this page: read from the target rather than paging through the gap. A page
+            # walked to its last row means this list is dense here, so the next one is bigger
+            self._fetch(target, grow=self.pos == len(rows) - 1)
+        else:
+            self.done = True
+
+    def frontier(self):
+        if self.done: return EXHAUSTED
+        return self.rows[self.pos]['SK'] if self.loaded else None
+
+class Intersection:
+    """AND of positive streams, minus any negated ones."""
+    def __init__(self, ctx, positive, negative):
+        self.ctx = ctx
+        self.streams = sorted(positive, key=lambda s: s.estimate)
+        self.negative = negative
+        self.estimate = self.streams[0].estimate
+        self.current, self.aligned = None, False
+
+    def _align(self, bound):
+        driver = self.streams[0]
+        while True:
+            key = driver.peek(bound)
+            # Past the caller's bound a lower bound is enough; the driver keeps its place
+            if key is None or (bound is not None and self.ctx.before(bound, key)):
+                return key
+            for stream in self.streams[1:]:
+                stream.seek(key)
+                found = stream.peek(key)
+                if found is None: return None
+                if found != key:
+                    driver.seek(found)
+                    break
+            else:
+                if not any(self._contains(stream, key) for stream in self.negative):
+                    return key
+                driver.advance()
+
+    def peek(self, bound=None):
+        if not self.aligned:
+            key = self._align(bound)
+            if key is not None and bound is not None and self.ctx.before(bound, key):
+                return key
+            self.current, self.aligned = key, True
+        return self.current
+
+    @staticmethod
+    def _contains(stream, key):
+        stream.seek(key)
+        return stream.peek(key) == key
+
+    def row(self):
+        return self.streams[0].row()
+
+    def advance(self):
+        self.streams[0].advance()
+        self.aligned = False
+
+    def seek(self, target):
+        self.streams[0].seek(target)
+        self.aligned = False
+
+    def frontier(self):
+        # A key before any positive stream's frontier is not in that stream, so not in the AND
+        keys = [s.frontier() for s in self.streams]
+        if any(k is EXHAUSTED for k in keys): return EXHAUSTED
+        known = [k for k in keys if k is not None]
+        return self.ctx.last(known) if known else None
+
+class Union:
+    """OR of streams, merged in key order."""
+    def __init__(self, ctx, streams):
+        self.ctx = ctx
+        # Cheap children first, so their keys bound the search in costly ones
+        self.streams = sorted(streams, key=lambda s: s.estimate)
+        self.estimate = sum(s.estimate for s in streams)
+        self.current = None
+
+    def peek(self, bound=None):
+        best = None
+        for stream in self.streams:
+            key = stream.peek(bound)
+            if key is not None and (best is None or self.ctx.before(key, best)):
+                best = key
+                if bound is None or self.ctx.before(key, bound): bound = key
+        self.current = best
+        return best
+
+    # row() and advance() act on the key the caller just peeked
+    def row(self):
+        key = self.current
+        return next(s.row() for s in self.streams if s.peek(key) == key)
+
+    def advance(self):
+        key = self.current
+        for stream in self.streams:
+            if stream.peek(key) == key: stream.advance()
+
+    def seek(self, target):
+        for stream in self.streams: stream.seek(target)
+
+    def frontier(self):
+        keys = [k for k in (s.frontier() for s in self.streams) if k is not EXHAUSTED]
+        if not keys: return EXHAUSTED
+        if any(k is None for k in keys): return None
+        return self.ctx.first(keys)
+
+def build(node, ctx, counts):
+    """Turns a parsed query into a stream; NOT needs a positive partner in its AND."""
+    kind = node[0]
+    if kind == 'tag':
+        return Postings(ctx, node[1], counts.get(node[1], 0))
+    if kind == 'not':
+        raise SearchError("NOT must be combined with a tag, e.g. Dog AND NOT Cat")
+    if kind == 'or':
+        return Union(ctx, [build(child, ctx, counts) for child in node[1]])
+    positive = [build(child, ctx, counts) for child in node[1] if child[0] != 'not']
+    negative = [build(child[1], ctx, counts) for child in node[1] if child[0] == 'not']
+    if not positive:
+        raise SearchError("NOT must be combined with a tag, e.g. Dog AND NOT Cat")
+    return Intersection(ctx, positive, negative)
+
+def tag_counts(table, user_id, tags):
+    """Posting list sizes from the tag cloud; a tag missing there is empty and drives its AND."""
+    keys = [{'PK': f"USER#{user_id}#TAG_CLOUD", 'SK': f"TAG#{tag}"} for tag in sorted(tags)]
+    with carnus_metrics.stage('DynamoDB'):
+        resp = table.meta.client.batch_get_item(RequestItems={table.name: {
+            'Keys': keys,
+            'ProjectionExpression': 'SK, #c',
+            'ExpressionAttributeNames': {'#c': 'Count'}
+        }})
+    counts = {item['SK'][len("TAG#"):]: int(item.get('Count', 0)) for item in resp['Responses'].get(table.name, [])}
+    # Unread counts only lose the ordering hint, never results
+    for key in resp.get('UnprocessedKeys', {}).get(table.name, {}).get('Keys', []):
+        counts[key['SK'][len("TAG#"):]] = float('inf')
+    return counts
+
+# --- SEARCH ---
+def search(table, user_id, q, date_from=None, date_to=None, order='desc', limit=50, next_token=None, budget=100):
+    """Returns (canonical query, posting rows, next_token) for one page of results."""
+    node = parse(q)
+    tags = tags_of(node)
+    if len(tags) > MAX_TAGS:
+        raise SearchError(f"At most {MAX_TAGS} tags per query")
+    query_id = fingerprint(node, order, date_from, date_to)
+    resume = decode_cursor(next_token, query_id) if next_token else None
+
+    ctx = SearchContext(table, user_id, order == 'asc', date_from, date_to, budget=budget)
+    top = build(node, ctx, tag_counts(table, user_id, tags))
+    rows, cursor = [], None
+
+    def progressed():
+        # Moved past the resume point: a row was returned or the decided frontier is beyond it
+        if rows: return True
+        frontier = top.frontier()
+        if frontier is EXHAUSTED: return True
+        return frontier is not None and (resume is None or ctx.before(resume[0], frontier))
+    ctx.progressed = progressed
+
+    try:
+        if resume:
+            key, returned = resume
+            top.seek(key)
+            if returned and top.peek() == key: top.advance()
+        while len(rows) < limit and top.peek() is not None:
+            rows.append(top.row())
+            top.advance()
+        if len(rows) == limit: cursor = (rows[-1]['SK'], True)
+    except BudgetExceeded:
+        # Resume from the furthest point every list has decided, never before what was returned
+        frontier = top.frontier()
+        if frontier is not EXHAUSTED:
+            cursor = (rows[-1]['SK'], True) if rows and not ctx.before(rows[-1]['SK'], frontier) else (frontier, False)
+        print(f"⏳ Search budget spent after {len(rows)} results: {describe(node)}")
+
+    carnus_metrics.add('SearchQueries', ctx.queries)
+    carnus_metrics.add('SearchResults', len(rows))
+    return describe(node), rows, encode_cursor(query_id, *cursor) if cursor else None
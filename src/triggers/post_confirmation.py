@@ -1,10 +1,9 @@
 import json
-import boto3, os
+import os
 from datetime import datetime, timezone
+import carnus_init
 
-dynamodb = boto3.resource('dynamodb')
 table_name = os.environ['TABLE_NAME']
-table = dynamodb.Table(table_name)
 
 def handler(event, context):
     user_attributes = event['request']['userAttributes']
@@ -29,7 +28,7 @@ def handler(event, context):
     }
 
     try:
-        table.put_item(Item=item)
+        carnus_init.table(table_name).put_item(Item=item)
         print(f"Profile created for {email} (Verified: {is_verified})")
     except Exception as e:
         print(f"Error creating profile: {str(e)}")
@@ -0,0 +1,138 @@
+"""Boolean tag search against an in-memory stand-in for the table (no AWS needed).
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import random
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[:0] = [os.path.join(ROOT, 'src', 'shared'), os.path.join(ROOT, 'src', 'tags')]
+os.environ.setdefault('METRICS', 'false')
+
+import carnus_keys
+import tag_search
+
+USER = "u"
+
+class FakeTable:
+    """Just the Query/BatchGetItem behaviour tag_search relies on, counting Queries."""
+    name = "carnus-test"
+
+    def __init__(self):
+        self.partitions = {}
+        self.queries = 0
+        table = self
+
+        class Client:
+            def batch_get_item(self, RequestItems):
+                keys = RequestItems[table.name]['Keys']
+                found = [table.partitions.get(k['PK'], {}).get(k['SK']) for k in keys]
+                return {'Responses': {table.name: [item for item in found if item]}}
+
+        class Meta:
+            client = Client()
+        self.meta = Meta()
+
+    def put(self, tag, capture_date, image_id):
+        sk = carnus_keys.tag_sort_key(capture_date, image_id)
+        self.partitions.setdefault(f"USER#{USER}#TAG#{tag}", {})[sk] = {
+            'PK': f"USER#{USER}#TAG#{tag}", 'SK': sk, 'ImageId': image_id, 'Timestamp': capture_date}
+        return sk
+
+    def count_tags(self):
+        for pk, rows in list(self.partitions.items()):
+            if '#TAG#' in pk:
+                tag = pk.split('#TAG#', 1)[1]
+                self.partitions.setdefault(f"USER#{USER}#TAG_CLOUD", {})[f"TAG#{tag}"] = {'SK': f"TAG#{tag}", 'Count': len(rows)}
+
+    def query(self, KeyConditionExpression, ScanIndexForward, Limit, ExclusiveStartKey=None):
+        self.queries += 1
+        pk_condition, sk_condition = KeyConditionExpression.get_expression()['values']
+        pk = pk_condition.get_expression()['values'][1]
+        _, low, high = sk_condition.get_expression()['values']
+        keys = sorted((k for k in self.partitions.get(pk, {}) if low <= k <= high), reverse=not ScanIndexForward)
+        if ExclusiveStartKey:
+            after = ExclusiveStartKey['SK']
+            keys = [k for k in keys if (k > after if ScanIndexForward else k < after)]
+        page = keys[:Limit]
+        resp = {'Items': [self.partitions[pk][k] for k in page]}
+        if len(keys) > Limit: resp['LastEvaluatedKey'] = {'PK': pk, 'SK': page[-1]}
+        return resp
+
+def search_all(table, q, max_pages=5000, **kwargs):
+    """Pages until next_token is None; every page must move the cursor."""
+    keys, token, pages = [], None, 0
+    while True:
+        _, rows, next_token = tag_search.search(table, USER, q, next_token=token, **kwargs)
+        keys += [row['SK'] for row in rows]
+        pages += 1
+        if next_token is None:
+            return keys, pages
+        assert next_token != token, "a page returned its own cursor"
+        assert pages < max_pages
+        token = next_token
+
+def date(i):
+    return f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d}T{i % 24:02d}:{i % 60:02d}:00"
+
+def test_large_negated_branch_or_small_branch():
+    table = FakeTable()
+    for i in range(20000):
+        table.put('Dog', date(i), f"dog{i:05d}")
+        table.put('Animal', date(i), f"dog{i:05d}")
+    cats = {table.put('Cat', date(i * 37), f"cat{i:02d}") for i in range(10)}
+    table.count_tags()
+
+    keys, pages = search_all(table, '(Dog AND NOT Animal) OR Cat', budget=100)
+    assert keys == sorted(cats, reverse=True)
+    assert pages < 200
+
+@pytest.mark.parametrize('budget', [1, 10, 20, 100])
+def test_paging_terminates_and_matches_every_list(budget):
+    rng = random.Random(budget)
+    table = FakeTable()
+    odds = {'Dog': 0.6, 'Cat': 0.3, 'Beach': 0.1, 'Sunset Sky': 0.05, 'Rare': 0.01}
+    members = {tag: set() for tag in odds}
+    for i in range(1500):
+        for tag, p in odds.items():
+            if rng.random() < p:
+                members[tag].add(table.put(tag, date(i), f"id{i:04d}"))
+    table.count_tags()
+
+    def expected(node):
+        if node[0] == 'tag': return members.get(node[1], set())
+        if node[0] == 'or': return set().union(*(expected(child) for child in node[1]))
+        result = set.intersection(*(expected(child) for child in node[1] if child[0] != 'not'))
+        for child in node[1]:
+            if child[0] == 'not': result -= expected(child[1])
+        return result
+
+    queries = ['Dog AND Cat', 'Rare Dog', 'Dog OR Cat', '(Dog AND NOT Cat) OR Rare',
+               '(Beach OR "Sunset Sky") AND NOT Cat', 'Dog AND (Cat OR Beach) AND NOT "Sunset Sky"',
+               '(Dog AND NOT (Cat OR Beach)) OR "Sunset Sky"', 'Missing OR Rare']
+    for q in queries:
+        for order in ('asc', 'desc'):
+            for date_from, date_to in ((None, None), ('2024-03', '2024-07-15')):
+                low, high = carnus_keys.dated_bounds(date_from, date_to)
+                want = sorted((k for k in expected(tag_search.parse(q)) if low <= k <= high), reverse=order == 'desc')
+                got, _ = search_all(table, q, order=order, date_from=date_from, date_to=date_to, limit=7, budget=budget)
+                assert got == want, (q, order, date_from)
+
+def test_and_reads_follow_the_rarest_tag():
+    table = FakeTable()
+    for i in range(5000):
+        table.put('Dog', date(i), f"id{i:04d}")
+        if i % 500 == 0: table.put('Rare', date(i), f"id{i:04d}")
+    table.count_tags()
+
+    keys, _ = search_all(table, 'Dog AND Rare', limit=100, budget=1000)
+    assert len(keys) == 10
+    assert table.queries <= 2 * 10 + 2
+
+@pytest.mark.parametrize('q', ['', 'NOT Dog', 'Dog AND', '(Dog', 'Dog)', 'Dog OR OR Cat'])
+def test_rejects_bad_queries(q):
+    with pytest.raises(tag_search.SearchError):
+        tag_search.search(FakeTable(), USER, q)